@@ -0,0 +1,216 @@
+"""Motor de analítica: citas en arreglos columnares de NumPy y métricas vectorizadas.
+
+Las citas se cargan por lotes en columnas (fecha y creación como segundos
+epoch en hora local, índice de servicio, precio y código de estado) y cada
+métrica es una agrupación con bincount/searchsorted sobre esas columnas, sin
+recorrer las citas en Python.
+
+Las fechas de las citas son hora local sin zona; created_at se guarda en UTC
+y se pasa a hora local con el desfase que recibe ColumnBuilder.
+"""
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+STATES = ["pendiente", "confirmada", "completada", "cancelada"]
+CONFIRMED = STATES.index("confirmada")
+CANCELLED = STATES.index("cancelada")
+DAY = 86400
+MISSING = np.iinfo(np.int64).min
+
+
+def parse_local_epoch(values: List[str]) -> np.ndarray:
+    """Segundos epoch de fechas ISO; las que faltan quedan como MISSING"""
+    return np.array([v[:19] if v else "NaT" for v in values], dtype="datetime64[s]").astype(np.int64)
+
+
+def date_epoch(day: date) -> int:
+    return int(np.datetime64(day.isoformat(), "s").astype(np.int64))
+
+
+class AppointmentColumns:
+    """Citas como columnas paralelas de NumPy, una posición por cita"""
+
+    def __init__(self, fecha, created, service, price, state, service_ids: List[str]):
+        self.fecha = fecha
+        self.created = created
+        self.service = service
+        self.price = price
+        self.state = state
+        self.service_ids = service_ids
+        self.sorted_created = None
+
+    def __len__(self) -> int:
+        return len(self.fecha)
+
+    def window(self, desde: Optional[date] = None, hasta: Optional[date] = None) -> np.ndarray:
+        """Máscara de las citas con fecha entre desde y hasta (inclusive)"""
+        mask = np.ones(len(self), dtype=bool)
+        if desde:
+            mask &= self.fecha >= date_epoch(desde)
+        if hasta:
+            mask &= self.fecha < date_epoch(hasta + timedelta(days=1))
+        return mask
+
+    def created_sorted(self) -> np.ndarray:
+        if self.sorted_created is None:
+            self.sorted_created = np.sort(self.created[self.created != MISSING])
+        return self.sorted_created
+
+
+class ColumnBuilder:
+    """Acumula lotes de documentos de citas y los une en AppointmentColumns"""
+
+    def __init__(self, service_prices: Dict[str, float], utc_offset: int = 0):
+        self.service_prices = service_prices
+        self.utc_offset = utc_offset
+        self.service_index: Dict[str, int] = {}
+        self.chunks = []
+
+    def service_code(self, service_id: str) -> int:
+        code = self.service_index.get(service_id)
+        if code is None:
+            code = self.service_index[service_id] = len(self.service_index)
+        return code
+
+    def add_batch(self, docs: Iterable[dict]):
+        docs = list(docs)
+        if not docs:
+            return
+        created = parse_local_epoch([doc.get("created_at") for doc in docs])
+        created = np.where(created == MISSING, MISSING, created + self.utc_offset)
+        self.chunks.append((
+            parse_local_epoch([doc["fecha"] for doc in docs]),
+            created,
+            np.array([self.service_code(doc["service_id"]) for doc in docs], dtype=np.int32),
+            np.array([doc.get("precio", self.service_prices.get(doc["service_id"], 0)) or 0 for doc in docs], dtype=np.float64),
+            np.array([STATES.index(doc["estado"]) if doc.get("estado") in STATES else -1 for doc in docs], dtype=np.int8),
+        ))
+
+    def build(self) -> AppointmentColumns:
+        if self.chunks:
+            columns = [np.concatenate(parts) for parts in zip(*self.chunks)]
+        else:
+            columns = [np.empty(0, dtype=dtype) for dtype in (np.int64, np.int64, np.int32, np.float64, np.int8)]
+        service_ids = sorted(self.service_index, key=self.service_index.get)
+        return AppointmentColumns(*columns, service_ids)
+
+
+def weekday_hour(fecha: np.ndarray):
+    """Día de la semana (0 = lunes) y hora de cada fecha epoch; el 1970-01-01 fue jueves"""
+    days = fecha // DAY
+    return (days + 3) % 7, (fecha % DAY) // 3600
+
+
+def month_codes(fecha: np.ndarray) -> np.ndarray:
+    """Meses desde 1970-01 de cada fecha epoch"""
+    return fecha.astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+
+
+def month_label(code: int) -> str:
+    return str(np.datetime64(int(code), "M"))
+
+
+def occupancy_heatmap(cols: AppointmentColumns, mask: np.ndarray) -> np.ndarray:
+    """Matriz 7x24 (día de la semana x hora) de citas no canceladas"""
+    weekday, hour = weekday_hour(cols.fecha[mask & (cols.state != CANCELLED)])
+    return np.bincount(weekday * 24 + hour, minlength=7 * 24).reshape(7, 24)
+
+
+def revenue_by_service_month(cols: AppointmentColumns, mask: np.ndarray) -> List[dict]:
+    """Ingresos y citas confirmadas por (mes, servicio)"""
+    selected = mask & (cols.state == CONFIRMED)
+    if not selected.any():
+        return []
+    months = month_codes(cols.fecha[selected])
+    first = months.min()
+    n_services = max(len(cols.service_ids), 1)
+    keys = (months - first) * n_services + cols.service[selected]
+    size = int(keys.max()) + 1
+    revenue = np.bincount(keys, weights=cols.price[selected], minlength=size)
+    counts = np.bincount(keys, minlength=size)
+    return [
+        {
+            "mes": month_label(first + key // n_services),
+            "service_id": cols.service_ids[key % n_services],
+            "ingresos": round(float(revenue[key]), 2),
+            "citas": int(counts[key])
+        }
+        for key in np.flatnonzero(counts)
+    ]
+
+
+def lead_time(cols: AppointmentColumns, mask: np.ndarray) -> dict:
+    """Anticipación (horas entre la reserva y la cita) de las citas no canceladas"""
+    selected = mask & (cols.state != CANCELLED) & (cols.created != MISSING)
+    hours = (cols.fecha[selected] - cols.created[selected]) / 3600
+    if not len(hours):
+        return {"citas": 0, "promedio_horas": 0.0, "mediana_horas": 0.0, "p90_horas": 0.0, "por_servicio": []}
+
+    services = cols.service[selected]
+    n_services = max(len(cols.service_ids), 1)
+    counts = np.bincount(services, minlength=n_services)
+    totals = np.bincount(services, weights=hours, minlength=n_services)
+    median, p90 = np.percentile(hours, [50, 90])
+    return {
+        "citas": int(len(hours)),
+        "promedio_horas": round(float(hours.mean()), 1),
+        "mediana_horas": round(float(median), 1),
+        "p90_horas": round(float(p90), 1),
+        "por_servicio": [
+            {"service_id": cols.service_ids[i], "citas": int(counts[i]), "promedio_horas": round(float(totals[i] / counts[i]), 1)}
+            for i in np.flatnonzero(counts)
+        ]
+    }
+
+
+def cancellation_rates(cols: AppointmentColumns, mask: np.ndarray) -> dict:
+    """Tasa de cancelación total, por servicio y por mes"""
+    cancelled = cols.state[mask] == CANCELLED
+    total = int(mask.sum())
+    if not total:
+        return {"citas": 0, "canceladas": 0, "tasa": 0.0, "por_servicio": [], "por_mes": []}
+
+    def rates(keys, labels):
+        counts = np.bincount(keys)
+        cancels = np.bincount(keys, weights=cancelled, minlength=len(counts))
+        return [
+            {**labels(key), "citas": int(counts[key]), "canceladas": int(cancels[key]), "tasa": round(float(cancels[key] / counts[key]), 4)}
+            for key in np.flatnonzero(counts)
+        ]
+
+    months = month_codes(cols.fecha[mask])
+    first = months.min()
+    return {
+        "citas": total,
+        "canceladas": int(cancelled.sum()),
+        "tasa": round(float(cancelled.mean()), 4),
+        "por_servicio": rates(cols.service[mask], lambda key: {"service_id": cols.service_ids[key]}),
+        "por_mes": rates(months - first, lambda key: {"mes": month_label(first + key)})
+    }
+
+
+def promotion_uplift(cols: AppointmentColumns, starts: np.ndarray, ends: np.ndarray) -> List[dict]:
+    """Reservas creadas durante cada promoción frente a un periodo igual justo antes.
+
+    starts/ends son segundos epoch locales de cada vigencia [inicio, fin).
+    uplift es la variación relativa de reservas por día (None sin base de comparación).
+    """
+    created = cols.created_sorted()
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = np.maximum(ends - starts, 1)
+    during = np.searchsorted(created, ends) - np.searchsorted(created, starts)
+    before = np.searchsorted(created, starts) - np.searchsorted(created, starts - lengths)
+    days = lengths / DAY
+    return [
+        {
+            "citas_durante": int(during[i]),
+            "citas_antes": int(before[i]),
+            "por_dia_durante": round(float(during[i] / days[i]), 2),
+            "por_dia_antes": round(float(before[i] / days[i]), 2),
+            "uplift": round(float(during[i] / before[i] - 1), 4) if before[i] else None
+        }
+        for i in range(len(starts))
+    ]
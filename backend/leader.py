@@ -0,0 +1,143 @@
+"""Elección de líder entre procesos con un lease guardado en Mongo.
+
+Cada proceso intenta tomar el documento del lease: lo consigue si no existe,
+si está vencido o si ya es suyo. El dueño lo renueva (heartbeat) cada tercio
+del TTL; si deja de hacerlo (proceso caído, red cortada), el lease vence y
+otro proceso lo toma.
+
+Cada cambio de dueño incrementa el token de fencing. Quien trabaja como
+líder usa su token para marcar lo que escribe y comprueba con check() que
+el lease sigue siendo suyo antes de reclamar trabajo.
+
+Los vencimientos se calculan con el reloj del servidor de Mongo ($$NOW), así
+que no dependen de que los relojes de los procesos estén sincronizados.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class LeaderLease:
+    """Lease renovable con token de fencing sobre una colección de Mongo"""
+
+    def __init__(
+        self,
+        collection,
+        name: str,
+        ttl: float,
+        on_elected: Optional[Callable[[int], Awaitable[None]]] = None,
+        on_demoted: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.token: Optional[int] = None
+        self.valid_until = 0.0
+        self.task = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None
+
+    async def try_acquire(self) -> Optional[int]:
+        """Toma o renueva el lease; devuelve el token de fencing, o None si lo tiene otro"""
+        try:
+            lease = await self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [
+                    {"owner": self.owner},
+                    {"$expr": {"$lt": ["$expires_at", "$$NOW"]}}
+                ]},
+                [{"$set": {
+                    # Renovar conserva el token; tomar el lease de otro lo incrementa
+                    "token": {"$cond": [
+                        {"$eq": ["$owner", self.owner]},
+                        "$token",
+                        {"$add": [{"$ifNull": ["$token", 0]}, 1]}
+                    ]},
+                    "owner": self.owner,
+                    "expires_at": {"$add": ["$$NOW", int(self.ttl * 1000)]}
+                }}],
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # El lease existe y es de otro proceso: el filtro no coincidió y el upsert chocó con _id
+            return None
+        return lease["token"]
+
+    async def check(self) -> bool:
+        """True si el lease sigue siendo de este proceso con el mismo token"""
+        if self.token is None or asyncio.get_running_loop().time() >= self.valid_until:
+            return False
+        lease = await self.collection.find_one({
+            "_id": self.name,
+            "owner": self.owner,
+            "token": self.token,
+            "$expr": {"$gt": ["$expires_at", "$$NOW"]}
+        })
+        return lease is not None
+
+    async def heartbeat(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            token = await self.try_acquire()
+        except Exception as e:
+            logging.error(f"Error renovando el lease {self.name}: {str(e)}")
+            # Sin respuesta de Mongo se sigue como líder solo hasta que el lease venza
+            if self.token is not None and loop.time() >= self.valid_until:
+                await self.set_token(None)
+            return
+        if token is not None:
+            self.valid_until = started + self.ttl
+        await self.set_token(token)
+
+    async def set_token(self, token: Optional[int]):
+        if token == self.token:
+            return
+        if self.token is not None:
+            logging.warning(f"Lease {self.name} perdido (token {self.token})")
+            self.token = None
+            if self.on_demoted:
+                await self.on_demoted()
+        if token is not None:
+            self.token = token
+            logging.info(f"Lease {self.name} tomado por {self.owner} (token {token})")
+            if self.on_elected:
+                await self.on_elected(token)
+
+    async def run(self):
+        while True:
+            await self.heartbeat()
+            await asyncio.sleep(self.ttl / 3)
+
+    async def start(self):
+        if self.task:
+            return
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Deja de renovar y libera el lease para que otro proceso lo tome sin esperar el TTL"""
+        if not self.task:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        if self.token is not None:
+            try:
+                await self.collection.update_one(
+                    {"_id": self.name, "owner": self.owner, "token": self.token},
+                    [{"$set": {"expires_at": "$$NOW"}}]
+                )
+            except Exception as e:
+                logging.error(f"Error liberando el lease {self.name}: {str(e)}")
+            await self.set_token(None)
@@ -0,0 +1,52 @@
+"""Comandos de mantenimiento del backend.
+
+Uso: python manage.py <comando>
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from server import (
+    backfill_review_names,
+    backfill_slot_claims,
+    client_db,
+    ensure_indexes,
+    migrate_data_urls_to_blobs,
+    privatize_payment_proofs,
+    rebuild_service_ratings,
+    rebuild_stats_rollups,
+    rerender_image_variants,
+    verify_stats_rollups,
+)
+
+COMMANDS = {
+    "rebuild-ratings": rebuild_service_ratings,
+    "migrate-blobs": migrate_data_urls_to_blobs,
+    "render-variants": rerender_image_variants,
+    "privatize-proofs": privatize_payment_proofs,
+    "backfill-slot-claims": backfill_slot_claims,
+    "backfill-review-names": backfill_review_names,
+    "rebuild-stats": rebuild_stats_rollups,
+    "verify-stats": verify_stats_rollups,
+}
+
+async def run(command: str):
+    """Ejecuta el comando; devuelve False si el comando reportó un fallo"""
+    try:
+        await ensure_indexes()
+        return await COMMANDS[command]()
+    finally:
+        client_db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Comandos de mantenimiento de Beauty Touch Nails")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    if asyncio.run(run(args.command)) is False:
+        logging.error(f"Comando {args.command} falló")
+        sys.exit(1)
+    logging.info(f"Comando {args.command} completado")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Token bucket para limitar el ritmo de envío hacia APIs externas."""
+import asyncio
+import time
+from typing import Callable, Optional
+
+
+class TokenBucket:
+    """Bucket de `rate` tokens por segundo con capacidad `burst`.
+
+    pause() vacía el bucket y bloquea nuevas salidas durante un tiempo, para
+    respetar un Retry-After del proveedor.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate debe ser positivo")
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.paused_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> float:
+        """Toma un token si hay; si no, devuelve cuántos segundos faltan para el próximo"""
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        now = self.clock()
+        self.refill(now)
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, now + seconds)
@@ -0,0 +1,58 @@
+"""Motor de agenda: intervalos ocupados [inicio, fin) de un recurso en un día.
+
+Los tiempos se expresan en minutos desde la medianoche. Los intervalos se
+guardan fusionados en bloques disjuntos y ordenados, así que cada consulta
+de solapamiento es una búsqueda binaria (O(log n)).
+"""
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional
+
+
+def minute_of_day(hora: str) -> int:
+    """Convierte "HH:MM" (o "HH:MM:SS") en minutos desde la medianoche"""
+    hours, minutes = hora.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def format_minute(minute: int) -> str:
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+class BusyIntervals:
+    """Unión de intervalos ocupados como bloques [inicio, fin) disjuntos y ordenados"""
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def add(self, start: int, end: int):
+        """Marca [start, end) como ocupado, fusionando los bloques que toca"""
+        if end <= start:
+            raise ValueError("El intervalo debe terminar después de empezar")
+        # Bloques que se solapan o son contiguos: desde el primero con fin >= start
+        # hasta el último con inicio <= end
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def overlaps(self, start: int, end: int) -> bool:
+        """True si [start, end) se solapa con algún bloque ocupado"""
+        i = bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def free_starts(self, candidates: Iterable[int], duration: int, limit: Optional[int] = None) -> List[int]:
+        """Inicios candidatos (en orden) donde cabe un intervalo de la duración dada"""
+        free = []
+        for start in candidates:
+            if not self.overlaps(start, start + duration):
+                free.append(start)
+                if limit is not None and len(free) >= limit:
+                    break
+        return free
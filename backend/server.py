@@ -1,45 +1,235 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Request, Response, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, date, timezone, timedelta
 import uuid
 import bcrypt
 import jwt
-from twilio.rest import Client
+import aiohttp
 import base64
+import mimetypes
+import re
+import tempfile
+import io
+import csv
+from PIL import Image, ImageOps
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import asyncio
+import time
+import hashlib
+import hmac
+import json
+import heapq
+from collections import OrderedDict
+from scheduling import BusyIntervals, minute_of_day, format_minute
+from ratelimit import TokenBucket
+from leader import LeaderLease
+import analytics
+from contextlib import contextmanager
+import contextvars
+from zoneinfo import ZoneInfo
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+class QueryCounter(monitoring.CommandListener):
+    """Cuenta los comandos enviados a Mongo dentro del contexto activo (ver count_queries).
+
+    Los getMore no cuentan: son la continuación de un cursor ya abierto.
+    """
+
+    current = contextvars.ContextVar('query_counter', default=None)
+
+    def __init__(self):
+        self.total = 0
+        self.commands = {}
+
+    def started(self, event):
+        counter = QueryCounter.current.get()
+        if counter is not None and event.command_name != 'getMore':
+            counter.total += 1
+            counter.commands[event.command_name] = counter.commands.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+@contextmanager
+def count_queries():
+    """Cuenta las consultas a Mongo hechas dentro del bloque (también en tareas creadas en él)"""
+    counter = QueryCounter()
+    token = QueryCounter.current.set(counter)
+    try:
+        yield counter
+    finally:
+        QueryCounter.current.reset(token)
+
+def assert_max_queries(counter: QueryCounter, limit: int):
+    assert counter.total <= limit, f"Se esperaban como máximo {limit} consultas, se hicieron {counter.total}: {counter.commands}"
+
 mongo_url = os.environ['MONGO_URL']
-client_db = AsyncIOMotorClient(mongo_url)
+client_db = AsyncIOMotorClient(mongo_url, event_listeners=[QueryCounter()])
 db = client_db[os.environ['DB_NAME']]
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 security = HTTPBearer()
+# Rutas que aceptan el token Bearer o una URL firmada (p. ej. el <img> del comprobante)
+optional_security = HTTPBearer(auto_error=False)
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
+JWT_CACHE_ENABLED = os.environ.get('JWT_CACHE_ENABLED', 'true').lower() == 'true'
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '10000'))
+
+# Expone X-Query-Count en cada respuesta (solo para pruebas)
+QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER', 'false').lower() == 'true'
+
+# Las fechas de las citas se guardan en hora local del negocio, sin zona
+BUSINESS_TZ = ZoneInfo(os.environ['BUSINESS_TZ']) if os.environ.get('BUSINESS_TZ') else None
+
+# Recordatorios: se envían REMINDER_LEAD antes de la cita; si el proceso estuvo
+# caído, los vencidos hace menos de REMINDER_GRACE todavía se envían
+REMINDER_LEAD = timedelta(hours=24)
+REMINDER_GRACE = timedelta(hours=1)
+REMINDER_STATES = ["confirmada", "pendiente"]
+# Estados que ocupan horario (tienen slot_claims)
+ACTIVE_STATES = ["pendiente", "confirmada", "completada"]
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '500'))
+# Cada cuánto se recargan desde Mongo los recordatorios próximos (el heap solo guarda dos periodos)
+REMINDER_REFILL_MINUTES = int(os.environ.get('REMINDER_REFILL_MINUTES', '5'))
+REMINDER_HORIZON = timedelta(minutes=2 * REMINDER_REFILL_MINUTES)
+
+# Con varios workers/réplicas solo el líder corre los jobs programados
+LEADER_LEASE_SECONDS = float(os.environ.get('LEADER_LEASE_SECONDS', '15'))
+
+# Horarios de atención (ver HORARIOS_Y_NOTIFICACIONES.md): slots por día de la semana, lunes = 0
+BUSINESS_HOURS = {0: (10, 19), 1: (10, 19), 2: (10, 19), 3: (10, 19), 4: (10, 19), 5: (10, 15)}
+SLOT_TEMPLATE = {
+    weekday: [f"{hour:02d}:00" for hour in range(BUSINESS_HOURS[weekday][0], BUSINESS_HOURS[weekday][1] + 1)]
+    if weekday in BUSINESS_HOURS else []
+    for weekday in range(7)
+}
+AVAILABILITY_RANGE_MAX_DAYS = 60
+# Granularidad (minutos) de los documentos slot_claims que reservan cada intervalo
+SLOT_CLAIM_MINUTES = int(os.environ.get('SLOT_CLAIM_MINUTES', '15'))
+# Un slot_claim queda pendiente hasta que se guarda su cita; si el proceso cae
+# antes, el índice TTL lo borra pasado este plazo (segundos)
+SLOT_CLAIM_PENDING_SECONDS = int(os.environ.get('SLOT_CLAIM_PENDING_SECONDS', '300'))
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('AVAILABILITY_CACHE_SIZE', '5000'))
+# Otros workers no actualizan esta caché, así que se limita su antigüedad
+AVAILABILITY_CACHE_TTL = float(os.environ.get('AVAILABILITY_CACHE_TTL', '30'))
+
+# Límite de antigüedad del catálogo en caché (otros workers no ven los bumps de versión)
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '60'))
+# Contadores del panel de admin: se recalculan como mucho cada STATS_CACHE_TTL segundos
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', '5'))
+# Analítica: las columnas de citas se cargan por lotes y se reutilizan ANALYTICS_CACHE_TTL
+# segundos; después se recargan en segundo plano sirviendo las anteriores (ver analytics_memo)
+ANALYTICS_CACHE_TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', '300'))
+ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', '10000'))
+# Exportaciones: filas que se leen, completan y codifican juntas antes de enviarlas
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+# Almacén de imágenes en disco direccionado por SHA-256
+BLOB_DIR = Path(os.environ.get('BLOB_DIR', ROOT_DIR / 'blobs'))
+BLOB_BASE_URL = os.environ.get('BLOB_BASE_URL', '/api/blobs').rstrip('/')
+BLOB_NAME_RE = re.compile(r'^([0-9a-f]{64})(\.[A-Za-z0-9]+)?$')
+# Vigencia mínima de las URL firmadas de los comprobantes de pago (segundos)
+PROOF_URL_TTL = int(os.environ.get('PROOF_URL_TTL', '600'))
+
+# Variantes redimensionadas de las imágenes del catálogo (ancho máximo en px)
+IMAGE_VARIANT_WIDTHS = {"thumb": 320, "card": 640, "full": 1600}
+IMAGE_VARIANT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+IMAGE_POOL_SIZE = int(os.environ.get('IMAGE_POOL_SIZE', '2'))
+image_executor = None
+
+# Límites de subida por ruta: tamaño máximo y tipos MIME aceptados. Solo formatos
+# pasivos: el tipo se comprueba contra los primeros bytes del archivo (ver sniff_content_type)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+IMAGE_UPLOAD_LIMIT = {
+    "max_bytes": int(float(os.environ.get('MAX_IMAGE_UPLOAD_MB', '10')) * 1024 * 1024),
+    "types": ["image/jpeg", "image/png", "image/webp"]
+}
+PROOF_UPLOAD_LIMIT = {
+    "max_bytes": int(float(os.environ.get('MAX_PROOF_UPLOAD_MB', '20')) * 1024 * 1024),
+    "types": ["image/jpeg", "image/png", "image/webp", "application/pdf"]
+}
+# Formato de Pillow -> tipo MIME de los blobs de imagen
+SNIFFED_IMAGE_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+UPLOAD_ROUTES = [
+    (re.compile(r'^/api/services/[^/]+/upload-image$'), IMAGE_UPLOAD_LIMIT),
+    (re.compile(r'^/api/gallery/[^/]+/upload-(before|after)$'), IMAGE_UPLOAD_LIMIT),
+    (re.compile(r'^/api/appointments/[^/]+/upload-proof$'), PROOF_UPLOAD_LIMIT)
+]
+# Margen para los encabezados multipart y los campos del formulario
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
 
 twilio_account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
 twilio_auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
 twilio_phone = os.environ.get('TWILIO_PHONE_NUMBER')
 twilio_whatsapp = os.environ.get('TWILIO_WHATSAPP_NUMBER', 'whatsapp:+14155238886')  # Twilio Sandbox por defecto
-twilio_client = None
-if twilio_account_sid and twilio_auth_token:
-    twilio_client = Client(twilio_account_sid, twilio_auth_token)
+twilio_configured = bool(twilio_account_sid and twilio_auth_token)
+TWILIO_API_URL = os.environ.get('TWILIO_API_URL', 'https://api.twilio.com').rstrip('/')
+
+# Outbox de notificaciones: workers asíncronos con reintentos y dead-letter
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '30'))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '5'))
+OUTBOX_DRAIN_SECONDS = float(os.environ.get('OUTBOX_DRAIN_SECONDS', '10'))
+
+# Ritmo máximo (mensajes/segundo), ráfaga y envíos simultáneos por canal
+TWILIO_CHANNEL_LIMITS = {
+    "whatsapp": {
+        "rate": float(os.environ.get('TWILIO_WHATSAPP_RATE', '10')),
+        "burst": float(os.environ.get('TWILIO_WHATSAPP_BURST', '10')),
+        "concurrency": int(os.environ.get('TWILIO_WHATSAPP_CONCURRENCY', '4'))
+    },
+    "sms": {
+        "rate": float(os.environ.get('TWILIO_SMS_RATE', '1')),
+        "burst": float(os.environ.get('TWILIO_SMS_BURST', '1')),
+        "concurrency": int(os.environ.get('TWILIO_SMS_CONCURRENCY', '1'))
+    }
+}
+# Pausa ante un 429 sin encabezado Retry-After
+TWILIO_THROTTLE_DEFAULT_SECONDS = float(os.environ.get('TWILIO_THROTTLE_DEFAULT_SECONDS', '5'))
 
 scheduler = AsyncIOScheduler()
 
+# Pool de procesos dedicado a bcrypt para no bloquear el event loop
+PASSWORD_POOL_SIZE = int(os.environ.get('PASSWORD_POOL_SIZE', os.cpu_count() or 2))
+PASSWORD_QUEUE_SIZE = int(os.environ.get('PASSWORD_QUEUE_SIZE', '64'))
+password_executor = None
+password_pending = 0
+
+# Costo de bcrypt calibrado al arrancar según la latencia objetivo por hash
+BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', '100'))
+BCRYPT_MIN_ROUNDS = int(os.environ.get('BCRYPT_MIN_ROUNDS', '10'))
+BCRYPT_MAX_ROUNDS = int(os.environ.get('BCRYPT_MAX_ROUNDS', '15'))
+# Costo fijo para todos los workers; sin él, cada proceso calibra el suyo
+BCRYPT_ROUNDS = os.environ.get('BCRYPT_ROUNDS')
+bcrypt_rounds = 12
+
+# Referencias a tareas en segundo plano para que no las recolecte el GC
+background_tasks = set()
+
 class UserRegister(BaseModel):
     email: EmailStr
     password: str
@@ -86,6 +276,7 @@ class Appointment(BaseModel):
     user_id: str
     service_id: str
     fecha: datetime
+    duracion: Optional[int] = None
     estado: str = "pendiente"
     comprobante_pago: Optional[str] = None
     reminder_sent: bool = False
@@ -123,9 +314,10 @@ class Review(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ReviewCreate(BaseModel):
-    service_id: str
+    # Opcional: el servicio reseñado es siempre el de la cita
+    service_id: Optional[str] = None
     appointment_id: str
-    rating: int
+    rating: int = Field(..., ge=1, le=5)
     comentario: str
 
 class GalleryItem(BaseModel):
@@ -160,12 +352,112 @@ class PackageCreate(BaseModel):
     service_ids: List[str]
     precio_paquete: float
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def hash_password(password: str, rounds: int = 12) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+def bcrypt_hash_rounds(hashed: str) -> int:
+    """Extrae el costo de un hash con formato $2b$<rounds>$..."""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
+
+def measure_bcrypt_rounds(target_ms: float, min_rounds: int, max_rounds: int) -> int:
+    """Devuelve el mayor costo cuyo hash tarda como máximo target_ms"""
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibracion', bcrypt.gensalt(rounds=rounds))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+        # Cada ronda extra duplica el tiempo: no tiene sentido medir la siguiente
+        if elapsed_ms * 2 > target_ms:
+            break
+    return chosen
+
+def spawn_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def start_password_executor():
+    """Crea el pool de procesos para hashing de contraseñas"""
+    global password_executor
+    if password_executor is None:
+        # spawn evita heredar los hilos de Motor/APScheduler al hacer fork
+        password_executor = ProcessPoolExecutor(
+            max_workers=PASSWORD_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+def stop_password_executor():
+    global password_executor
+    if password_executor is not None:
+        password_executor.shutdown(wait=True, cancel_futures=True)
+        password_executor = None
+
+async def run_password_task(func, *args):
+    """Ejecuta una operación bcrypt en el pool, rechazando con 503 si la cola está llena"""
+    global password_pending
+    if password_pending >= PASSWORD_POOL_SIZE + PASSWORD_QUEUE_SIZE:
+        raise HTTPException(status_code=503, detail="Servidor ocupado, intenta de nuevo en unos segundos")
+    
+    start_password_executor()
+    password_pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, func, *args)
+    finally:
+        password_pending -= 1
+
+async def calibrate_bcrypt_rounds():
+    """Calibra el costo de bcrypt en el propio pool, donde se calculan los hashes"""
+    global bcrypt_rounds
+    if BCRYPT_ROUNDS:
+        bcrypt_rounds = int(BCRYPT_ROUNDS)
+        logging.info(f"Costo de bcrypt fijado por BCRYPT_ROUNDS: {bcrypt_rounds} rondas")
+        return
+    try:
+        bcrypt_rounds = await run_password_task(
+            measure_bcrypt_rounds, BCRYPT_TARGET_MS, BCRYPT_MIN_ROUNDS, BCRYPT_MAX_ROUNDS
+        )
+        logging.info(f"Costo de bcrypt calibrado: {bcrypt_rounds} rondas (objetivo {BCRYPT_TARGET_MS}ms)")
+    except Exception as e:
+        logging.error(f"Error calibrando bcrypt, se usa {bcrypt_rounds} rondas: {str(e)}")
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_task(hash_password, password, bcrypt_rounds)
+
+async def rehash_password(user_id: str, password: str, old_hash: str):
+    """Regenera con el costo calibrado un hash guardado con un costo menor"""
+    try:
+        new_hash = await hash_password_async(password)
+        # Solo reemplaza si nadie cambió la contraseña mientras tanto
+        await db.users.update_one(
+            {"id": user_id, "password": old_hash},
+            {"$set": {"password": new_hash}}
+        )
+        logging.info(f"Hash de contraseña actualizado a {bcrypt_rounds} rondas para usuario {user_id}")
+    except Exception as e:
+        logging.error(f"Error regenerando hash de contraseña: {str(e)}")
+
+async def verify_password_async(password: str, hashed: str, user_id: Optional[str] = None) -> bool:
+    """Verifica la contraseña; si se indica user_id, regenera en segundo plano hashes con menor costo.
+
+    Solo se sube el costo, nunca se baja: los workers calibran cada uno el
+    suyo y, si quedan en costos distintos, no se reescriben el hash entre sí.
+    """
+    valid = await run_password_task(verify_password, password, hashed)
+    if valid and user_id and bcrypt_hash_rounds(hashed) < bcrypt_rounds:
+        spawn_background_task(rehash_password(user_id, password, hashed))
+    return valid
+
 def create_token(user_id: str, email: str, role: str) -> str:
     payload = {
         "user_id": user_id,
@@ -175,81 +467,430 @@ def create_token(user_id: str, email: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+class VerifiedTokenCache:
+    """LRU de tokens ya verificados, indexado por el SHA-256 del token.
+
+    Cada entrada se descarta al llegar a su claim exp, de modo que un token
+    vencido nunca se sirve desde la caché.
+    """
+
+    def __init__(self, max_size: int, enabled: bool = True):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.expirations = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def purge_expired(self, now: float):
+        while self.expirations and self.expirations[0][0] <= now:
+            exp, key = heapq.heappop(self.expirations)
+            entry = self.entries.get(key)
+            if entry and entry[1] <= now:
+                del self.entries[key]
+
+    def get(self, token: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        key = self.key_for(token)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token: str, payload: dict):
+        exp = payload.get("exp")
+        if not self.enabled or exp is None:
+            return
+        now = time.time()
+        self.purge_expired(now)
+        key = self.key_for(token)
+        self.entries[key] = (payload, float(exp))
+        self.entries.move_to_end(key)
+        heapq.heappush(self.expirations, (float(exp), key))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        # El heap puede acumular claves ya desalojadas por LRU
+        if len(self.expirations) > 2 * self.max_size:
+            self.expirations = [(e, k) for e, k in self.expirations if k in self.entries]
+            heapq.heapify(self.expirations)
+
+    def invalidate(self, user_id: Optional[str] = None, token: Optional[str] = None):
+        """Hook para revocación: purga un token concreto o todos los de un usuario"""
+        if token is not None:
+            self.entries.pop(self.key_for(token), None)
+        if user_id is not None:
+            for key in [k for k, (payload, _) in self.entries.items() if payload.get("user_id") == user_id]:
+                del self.entries[key]
+        if token is None and user_id is None:
+            self.entries.clear()
+            self.expirations = []
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+token_cache = VerifiedTokenCache(JWT_CACHE_SIZE, enabled=JWT_CACHE_ENABLED)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
     except:
         raise HTTPException(status_code=401, detail="Token inválido")
+    token_cache.put(token, payload)
+    return payload
 
 async def get_admin_user(user = Depends(get_current_user)):
     if user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Acceso denegado")
     return user
 
-def send_sms_notification(phone: str, message: str):
-    """Envía notificación por SMS"""
-    if twilio_client and twilio_phone:
+class BatchLoader:
+    """Agrupa los lookups por clave pedidos en el mismo tick en una sola consulta $in.
+
+    Los resultados se memorizan, así que cada clave se consulta una sola vez
+    durante la vida del loader (un request).
+    """
+
+    def __init__(self, collection, key: str = "id", projection: Optional[dict] = None):
+        self.collection = collection
+        self.key = key
+        self.projection = projection or {"_id": 0}
+        self.cache = {}
+        self.pending = {}
+
+    def load(self, value):
+        if value in self.cache:
+            return self.cache[value]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.cache[value] = future
+        if not self.pending:
+            loop.call_soon(lambda: spawn_background_task(self.dispatch()))
+        self.pending[value] = future
+        return future
+
+    async def load_many(self, values) -> list:
+        return list(await asyncio.gather(*(self.load(v) for v in values)))
+
+    async def dispatch(self):
+        batch, self.pending = self.pending, {}
         try:
-            twilio_client.messages.create(
-                body=message,
-                from_=twilio_phone,
-                to=phone
-            )
-            logging.info(f"SMS enviado a {phone}")
+            docs = await self.collection.find({self.key: {"$in": list(batch)}}, self.projection).to_list(None)
         except Exception as e:
-            logging.error(f"Error enviando SMS: {str(e)}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        by_key = {doc[self.key]: doc for doc in docs}
+        for value, future in batch.items():
+            if not future.done():
+                future.set_result(by_key.get(value))
+
+class DataLoaders:
+    """Loaders de un request: usuarios, servicios y reseñas por cita"""
+
+    def __init__(self):
+        self.users = BatchLoader(db.users, projection={"_id": 0, "password": 0})
+        self.services = BatchLoader(db.services)
+        self.reviews_by_appointment = BatchLoader(db.reviews, key="appointment_id")
+
+def get_loaders() -> DataLoaders:
+    return DataLoaders()
+
+def utc_iso(dt: datetime) -> str:
+    """ISO con microsegundos fijos para que las fechas se comparen bien como texto"""
+    return dt.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+class NotificationDeliveryError(Exception):
+    def __init__(self, status: Optional[int], detail: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status}: {detail}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        # Errores de red, 429 y 5xx se reintentan; el resto de 4xx (número inválido, etc.) no
+        return self.status is None or self.status == 429 or self.status >= 500
+
+def twilio_sender(channel: str) -> str:
+    return twilio_whatsapp if channel == "whatsapp" else twilio_phone
+
+async def send_twilio_message(session: aiohttp.ClientSession, channel: str, phone: str, message: str):
+    """Envía un mensaje por la API de Twilio; lanza NotificationDeliveryError si falla"""
+    from_number = twilio_sender(channel)
+    if channel == "whatsapp":
+        # El número del cliente debe tener el prefijo whatsapp:
+        to_number = f"whatsapp:{phone}" if not phone.startswith('whatsapp:') else phone
+    else:
+        to_number = phone
+    
+    url = f"{TWILIO_API_URL}/2010-04-01/Accounts/{twilio_account_sid}/Messages.json"
+    try:
+        async with session.post(
+            url,
+            data={"From": from_number, "To": to_number, "Body": message},
+            auth=aiohttp.BasicAuth(twilio_account_sid, twilio_auth_token)
+        ) as response:
+            if response.status >= 400:
+                retry_after = response.headers.get("Retry-After")
+                raise NotificationDeliveryError(
+                    response.status,
+                    await response.text(),
+                    float(retry_after) if retry_after and retry_after.isdigit() else None
+                )
+    except aiohttp.ClientError as e:
+        raise NotificationDeliveryError(None, str(e))
+
+def business_now() -> datetime:
+    """Hora actual del negocio, sin zona, comparable con las fechas guardadas de las citas"""
+    if BUSINESS_TZ is None:
+        return datetime.now()
+    return datetime.now(BUSINESS_TZ).replace(tzinfo=None)
+
+def outbox_message(phone: str, message: str, prefer_whatsapp: bool = True, key: Optional[str] = None) -> dict:
+    """Mensaje pendiente para el outbox; con key, el mismo mensaje no se encola dos veces"""
+    now = utc_iso(datetime.now(timezone.utc))
+    message = {
+        "id": str(uuid.uuid4()),
+        "channel": "whatsapp" if prefer_whatsapp else "sms",
+        "to": phone,
+        "body": message,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now
+    }
+    if key:
+        message["key"] = key
+    return message
+
+async def enqueue_notifications(messages: List[dict]) -> int:
+    """Inserta en el outbox varios mensajes creados con outbox_message; devuelve cuántos encoló"""
+    if not messages:
+        return 0
+    if not twilio_configured:
+        logging.info(f"Twilio no configurado, {len(messages)} notificaciones omitidas")
+        return 0
+    try:
+        await db.outbox.insert_many(messages, ordered=False)
+        queued = len(messages)
+    except BulkWriteError as e:
+        # Los mensajes con key ya encolada chocan con el índice único: no son un error
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        queued = e.details["nInserted"]
+    notification_outbox.metrics["queued"] += queued
+    notification_outbox.wake()
+    return queued
+
+async def send_notification(phone: str, message: str, prefer_whatsapp: bool = True):
+    """Encola una notificación por WhatsApp o SMS en el outbox"""
+    await enqueue_notifications([outbox_message(phone, message, prefer_whatsapp)])
+
+class NotificationOutbox:
+    """Pool de workers que toman mensajes del outbox y los envían con concurrencia acotada.
+
+    Un mensaje se toma con un lease (status "sending"); si el proceso muere,
+    el lease vence y otro worker lo retoma. Los fallos se reintentan con
+    backoff exponencial hasta OUTBOX_MAX_ATTEMPTS y luego pasan a "dead".
+
+    Cada número remitente tiene su token bucket y cada canal un límite de
+    envíos simultáneos; un 429 pausa el bucket y devuelve el mensaje a la
+    cola sin gastar un intento.
+    """
+
+    def __init__(self, workers: int):
+        self.worker_count = workers
+        self.workers = []
+        self.session = None
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.buckets = {}
+        self.semaphores = {
+            channel: asyncio.Semaphore(limits["concurrency"])
+            for channel, limits in TWILIO_CHANNEL_LIMITS.items()
+        }
+        self.metrics = {"queued": 0, "sent": 0, "throttled": 0, "failed": 0, "dead": 0}
+
+    def bucket_for(self, channel: str) -> TokenBucket:
+        sender = twilio_sender(channel)
+        if sender not in self.buckets:
+            limits = TWILIO_CHANNEL_LIMITS[channel]
+            self.buckets[sender] = TokenBucket(limits["rate"], limits["burst"])
+        return self.buckets[sender]
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def start(self):
+        if self.workers or not twilio_configured:
+            return
+        self.stopping = False
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self.workers = [asyncio.create_task(self.run_worker()) for _ in range(self.worker_count)]
+        logger.info(f"Outbox de notificaciones iniciado con {self.worker_count} workers")
+
+    async def stop(self):
+        """Deja de tomar mensajes y espera a que terminen los envíos en curso"""
+        if not self.workers:
+            return
+        self.stopping = True
+        self.wake()
+        done, pending = await asyncio.wait(self.workers, timeout=OUTBOX_DRAIN_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self.workers = []
+        await self.session.close()
+        self.session = None
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.outbox.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": utc_iso(now)}},
+                {"status": "sending", "locked_until": {"$lt": utc_iso(now)}}
+            ]},
+            {
+                "$set": {"status": "sending", "locked_until": utc_iso(now + timedelta(seconds=OUTBOX_LEASE_SECONDS))},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
 
-def send_whatsapp_notification(phone: str, message: str):
-    """Envía notificación por WhatsApp"""
-    if twilio_client and twilio_whatsapp:
-        try:
-            # El número del cliente debe tener el prefijo whatsapp:
-            to_whatsapp = f"whatsapp:{phone}" if not phone.startswith('whatsapp:') else phone
-            
-            twilio_client.messages.create(
-                body=message,
-                from_=twilio_whatsapp,
-                to=to_whatsapp
+    async def run_worker(self):
+        while not self.stopping:
+            try:
+                message = await self.claim()
+            except Exception as e:
+                logging.error(f"Error tomando mensajes del outbox: {str(e)}")
+                message = None
+            if message is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.deliver(message)
+            except Exception as e:
+                # Un error inesperado no debe matar al worker: el mensaje se reintenta con backoff
+                logging.error(f"Error entregando la notificación {message['id']}: {str(e)}")
+                try:
+                    await self.fail(message, NotificationDeliveryError(None, str(e)))
+                except Exception as e:
+                    # Sin poder reprogramarlo, el lease vence y otro worker lo retoma
+                    logging.error(f"Error reprogramando la notificación {message['id']}: {str(e)}")
+
+    async def deliver(self, message: dict):
+        channel = message["channel"]
+        bucket = self.bucket_for(channel)
+        async with self.semaphores[channel]:
+            while True:
+                wait = bucket.try_acquire()
+                if wait <= 0:
+                    break
+                # Esperar más que el lease haría que otro worker retome el mensaje
+                if wait > OUTBOX_LEASE_SECONDS / 2:
+                    await self.requeue(message, wait, "Límite de envío local")
+                    return
+                await asyncio.sleep(wait)
+            try:
+                await send_twilio_message(self.session, channel, message["to"], message["body"])
+            except NotificationDeliveryError as e:
+                await self.fail(message, e)
+                return
+        await db.outbox.update_one(
+            {"id": message["id"]},
+            {"$set": {"status": "sent", "sent_at": utc_iso(datetime.now(timezone.utc))}, "$unset": {"locked_until": ""}}
+        )
+        self.metrics["sent"] += 1
+        logging.info(f"{channel} enviado a {message['to']}")
+
+    async def requeue(self, message: dict, delay: float, reason: str):
+        """Devuelve el mensaje a la cola sin contar el intento (backpressure)"""
+        self.metrics["throttled"] += 1
+        await db.outbox.update_one(
+            {"id": message["id"]},
+            {
+                "$set": {
+                    "status": "pending",
+                    "last_error": reason,
+                    "next_attempt_at": utc_iso(datetime.now(timezone.utc) + timedelta(seconds=delay))
+                },
+                "$inc": {"attempts": -1},
+                "$unset": {"locked_until": ""}
+            }
+        )
+
+    async def fail(self, message: dict, error: NotificationDeliveryError):
+        if error.status == 429:
+            delay = error.retry_after or TWILIO_THROTTLE_DEFAULT_SECONDS
+            self.bucket_for(message["channel"]).pause(delay)
+            logging.warning(f"Twilio limitó el envío de {message['channel']}, pausa de {delay:.0f}s")
+            await self.requeue(message, delay, str(error))
+            return
+        if not error.retryable or message["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            self.metrics["dead"] += 1
+            await db.outbox.update_one(
+                {"id": message["id"]},
+                {"$set": {"status": "dead", "last_error": str(error)}, "$unset": {"locked_until": ""}}
             )
-            logging.info(f"WhatsApp enviado a {phone}")
-        except Exception as e:
-            logging.error(f"Error enviando WhatsApp: {str(e)}")
+            logging.error(f"Notificación {message['id']} descartada tras {message['attempts']} intentos: {str(error)}")
+            return
+        self.metrics["failed"] += 1
+        delay = error.retry_after or OUTBOX_RETRY_BASE_SECONDS * 2 ** (message["attempts"] - 1)
+        await db.outbox.update_one(
+            {"id": message["id"]},
+            {
+                "$set": {
+                    "status": "pending",
+                    "last_error": str(error),
+                    "next_attempt_at": utc_iso(datetime.now(timezone.utc) + timedelta(seconds=delay))
+                },
+                "$unset": {"locked_until": ""}
+            }
+        )
+        logging.warning(f"Error enviando notificación {message['id']}, reintento en {delay:.0f}s: {str(error)}")
+
+    async def stats(self) -> dict:
+        by_status = await db.outbox.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        return {
+            **self.metrics,
+            "outbox": {row["_id"]: row["count"] for row in by_status},
+            "reminders": reminder_timers.stats()
+        }
 
-def send_notification(phone: str, message: str, prefer_whatsapp: bool = True):
-    """Envía notificación por WhatsApp o SMS según disponibilidad"""
-    if prefer_whatsapp:
-        send_whatsapp_notification(phone, message)
-    else:
-        send_sms_notification(phone, message)
+notification_outbox = NotificationOutbox(OUTBOX_WORKERS)
 
-async def send_appointment_reminders():
-    """Job que se ejecuta cada hora para enviar recordatorios de citas"""
-    try:
-        now = datetime.now(timezone.utc)
-        
-        # Buscar citas en las próximas 24 horas que no han recibido recordatorio
-        appointments = await db.appointments.find({
-            "estado": {"$in": ["confirmada", "pendiente"]},
-            "reminder_sent": False
-        }, {"_id": 0}).to_list(1000)
-        
-        reminders_sent = 0
-        for apt in appointments:
-            apt_time = datetime.fromisoformat(apt["fecha"])
-            time_until = apt_time - now
-            
-            # Enviar recordatorio si la cita es en 23-25 horas
-            if timedelta(hours=23) <= time_until <= timedelta(hours=25):
-                user = await db.users.find_one({"id": apt["user_id"]}, {"_id": 0})
-                service = await db.services.find_one({"id": apt["service_id"]}, {"_id": 0})
-                
-                if user and service:
-                    fecha_formateada = apt_time.strftime("%d/%m/%Y")
-                    hora_formateada = apt_time.strftime("%I:%M %p")
-                    
-                    message = f"""🌸 *Beauty Touch Nails* 🌸
+def reminder_message(user: dict, service: dict, apt_time: datetime) -> str:
+    fecha_formateada = apt_time.strftime("%d/%m/%Y")
+    hora_formateada = apt_time.strftime("%I:%M %p")
+    
+    return f"""🌸 *Beauty Touch Nails* 🌸
 
 ¡Hola {user['nombre']}!
 
@@ -261,21 +902,714 @@ async def send_appointment_reminders():
 Te esperamos mañana. Si tienes alguna duda, contáctanos.
 
 ¡Gracias por confiar en nosotros! ✨"""
-                    
-                    send_notification(user["telefono"], message, prefer_whatsapp=True)
-                    
-                    await db.appointments.update_one(
-                        {"id": apt["id"]},
-                        {"$set": {"reminder_sent": True}}
-                    )
-                    reminders_sent += 1
-                    logging.info(f"Recordatorio enviado para cita {apt['id']} a {user['nombre']}")
-        
-        if reminders_sent > 0:
-            logging.info(f"Total de recordatorios enviados: {reminders_sent}")
+
+class ReminderTimers:
+    """Un temporizador por cita para enviar su recordatorio a la hora exacta (fecha - 24h).
+
+    Los temporizadores viven en un min-heap ordenado por hora de envío. Mongo
+    es el almacén persistente: al arrancar, y cada REMINDER_REFILL_MINUTES,
+    se cargan con una consulta por rango de fecha solo los recordatorios que
+    vencen dentro de REMINDER_HORIZON, así el trabajo crece con los
+    recordatorios por vencer y no con las citas guardadas.
+
+    Cancelar o reprogramar no busca en el heap: due_at guarda la hora vigente
+    de cada cita y las entradas que ya no coinciden se descartan al salir.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.metrics = {"sent": 0, "last_refill_at": None, "refill_ms": 0.0, "scanned": 0}
+
+    def stats(self) -> dict:
+        return {
+            **self.metrics,
+            "pending": len(self.due_at),
+            "leader": scheduler_lease.is_leader,
+            "fencing_token": scheduler_lease.token
+        }
+
+    def schedule(self, apt: dict):
+        """Programa (o reprograma) el recordatorio de una cita según su fecha y estado"""
+        if self.task is None:
+            # Este proceso no es el líder: la recarga del líder toma la cita
+            return
+        if apt.get("reminder_sent") or apt.get("estado") not in REMINDER_STATES:
+            self.cancel(apt["id"])
+            return
+        due = datetime.fromisoformat(apt["fecha"]) - REMINDER_LEAD
+        now = business_now()
+        if due < now - REMINDER_GRACE or due > now + REMINDER_HORIZON:
+            # Muy tarde para recordar, o todavía lejos: la próxima recarga lo toma
+            self.cancel(apt["id"])
+            return
+        if self.due_at.get(apt["id"]) == due:
+            return
+        self.due_at[apt["id"]] = due
+        heapq.heappush(self.heap, (due, apt["id"]))
+        if self.heap[0][1] == apt["id"]:
+            self.wakeup.set()
+
+    def cancel(self, appointment_id: str):
+        self.due_at.pop(appointment_id, None)
+
+    def drop_stale(self):
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    async def refill(self):
+        """Carga desde Mongo los recordatorios que vencen antes del horizonte"""
+        try:
+            started = time.perf_counter()
+            now = business_now()
+            cursor = db.appointments.find({
+                "reminder_sent": False,
+                "fecha": {
+                    "$gte": (now + REMINDER_LEAD - REMINDER_GRACE).isoformat(),
+                    "$lte": (now + REMINDER_LEAD + REMINDER_HORIZON).isoformat()
+                },
+                "estado": {"$in": REMINDER_STATES}
+            }, {"_id": 0, "id": 1, "fecha": 1, "estado": 1, "reminder_sent": 1}).batch_size(REMINDER_BATCH_SIZE)
+            
+            scanned = 0
+            async for apt in cursor:
+                scanned += 1
+                self.schedule(apt)
             
+            duration_ms = (time.perf_counter() - started) * 1000
+            self.metrics.update({
+                "last_refill_at": utc_iso(datetime.now(timezone.utc)),
+                "refill_ms": round(duration_ms, 1),
+                "scanned": scanned
+            })
+            logging.info(f"Recarga de recordatorios: {scanned} citas por vencer, {len(self.due_at)} programadas ({duration_ms:.0f}ms)")
+        except Exception as e:
+            logging.error(f"Error recargando recordatorios: {str(e)}")
+
+    async def start(self):
+        if self.task:
+            return
+        await self.refill()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if not self.task:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        self.heap = []
+        self.due_at = {}
+
+    def seconds_until_next(self) -> Optional[float]:
+        self.drop_stale()
+        if not self.heap:
+            return None
+        return max(0.0, (self.heap[0][0] - business_now()).total_seconds())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.fire_due()
+            except Exception as e:
+                logging.error(f"Error enviando recordatorios: {str(e)}")
+            # Se duerme hasta el próximo vencimiento, o hasta que se programe uno anterior
+            timeout = self.seconds_until_next()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=min(timeout, 300) if timeout is not None else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire_due(self):
+        now = business_now()
+        due_ids = []
+        self.drop_stale()
+        while self.heap and self.heap[0][0] <= now:
+            _, appointment_id = heapq.heappop(self.heap)
+            del self.due_at[appointment_id]
+            due_ids.append(appointment_id)
+            self.drop_stale()
+        
+        # Si un lote falla, sus citas siguen con reminder_sent False y la próxima recarga las retoma
+        for i in range(0, len(due_ids), REMINDER_BATCH_SIZE):
+            self.metrics["sent"] += await self.deliver(due_ids[i:i + REMINDER_BATCH_SIZE])
+
+    async def deliver(self, appointment_ids: List[str]) -> int:
+        """Encola los recordatorios vencidos y los marca enviados con el token de fencing del líder.
+
+        Cada mensaje lleva la key "reminder:<cita>", única en el outbox: si un
+        líder cae entre encolar y marcar, el siguiente vuelve a encolar sin
+        duplicar el mensaje.
+        """
+        token = scheduler_lease.token
+        if not await scheduler_lease.check():
+            logging.warning(f"Lease del scheduler perdido, {len(appointment_ids)} recordatorios quedan para el nuevo líder")
+            return 0
+        
+        now = business_now()
+        # Se vuelven a comprobar estado y fecha: si la cita se canceló o se movió
+        # en otro proceso, no se envía
+        due = {
+            "id": {"$in": appointment_ids},
+            "reminder_sent": False,
+            "fecha": {"$gte": (now + REMINDER_LEAD - REMINDER_GRACE).isoformat(), "$lte": (now + REMINDER_LEAD).isoformat()},
+            "estado": {"$in": REMINDER_STATES}
+        }
+        batch = await db.appointments.find(due, {"_id": 0, "id": 1, "user_id": 1, "service_id": 1, "fecha": 1}).to_list(None)
+        if not batch:
+            return 0
+        
+        loaders = DataLoaders()
+        users = await loaders.users.load_many([apt["user_id"] for apt in batch])
+        services = await loaders.services.load_many([apt["service_id"] for apt in batch])
+        messages = [
+            outbox_message(
+                user["telefono"],
+                reminder_message(user, service, datetime.fromisoformat(apt["fecha"])),
+                key=f"reminder:{apt['id']}"
+            )
+            for apt, user, service in zip(batch, users, services)
+            if user and service
+        ]
+        queued = await enqueue_notifications(messages)
+        
+        await db.appointments.update_many(
+            {**due, "id": {"$in": [apt["id"] for apt in batch]}},
+            {"$set": {"reminder_sent": True, "reminder_fence": token}}
+        )
+        logging.info(f"{queued} recordatorios encolados (token {token})")
+        return queued
+
+reminder_timers = ReminderTimers()
+
+async def start_leader_jobs(token: int):
+    await reminder_timers.start()
+    scheduler.resume()
+
+async def stop_leader_jobs():
+    scheduler.pause()
+    await reminder_timers.stop()
+
+scheduler_lease = LeaderLease(db.leases, "scheduler", LEADER_LEASE_SECONDS, start_leader_jobs, stop_leader_jobs)
+
+def blob_root(private: bool = False) -> Path:
+    """Raíz del almacén; los comprobantes de pago van en private/, que get_blob nunca sirve"""
+    return BLOB_DIR / 'private' if private else BLOB_DIR
+
+def blob_path(digest: str, private: bool = False) -> Path:
+    return blob_root(private) / digest[:2] / digest
+
+def blob_type_path(digest: str, private: bool = False) -> Path:
+    """Archivo junto al blob con el tipo MIME detectado al guardarlo"""
+    return blob_root(private) / digest[:2] / f"{digest}.type"
+
+def sniff_content_type(path) -> Optional[str]:
+    """Tipo MIME según el contenido (no según lo que declara el cliente), o None si no es un formato permitido"""
+    with open(path, 'rb') as f:
+        if f.read(5) == b'%PDF-':
+            return "application/pdf"
+    try:
+        with Image.open(path) as image:
+            return SNIFFED_IMAGE_TYPES.get(image.format)
+    except Exception:
+        return None
+
+def record_blob_type(digest: str, content_type: Optional[str], private: bool = False):
+    path = blob_type_path(digest, private)
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}")
+    tmp.write_text(content_type or "")
+    os.replace(tmp, path)
+
+def read_blob_type(digest: str, private: bool = False) -> Optional[str]:
+    """Tipo registrado de un blob; los guardados antes de registrarlo se detectan y registran ahora"""
+    try:
+        return blob_type_path(digest, private).read_text() or None
+    except FileNotFoundError:
+        content_type = sniff_content_type(blob_path(digest, private))
+        record_blob_type(digest, content_type, private)
+        return content_type
+
+def blob_url(digest: str, content_type: Optional[str]) -> str:
+    extension = mimetypes.guess_extension(content_type or '') or ''
+    return f"{BLOB_BASE_URL}/{digest}{extension}"
+
+def new_blob_tempfile():
+    tmp_dir = BLOB_DIR / 'tmp'
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+
+def commit_blob_file(tmp_name: str, digest: str, private: bool = False):
+    """Mueve un archivo temporal completo a su ruta definitiva (atómico)"""
+    path = blob_path(digest, private)
+    if path.exists():
+        os.unlink(tmp_name)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_name, path)
+
+def write_blob(data: bytes, content_type: Optional[str] = None, private: bool = False) -> str:
+    """Guarda el contenido en el almacén (idempotente) y devuelve su SHA-256.
+
+    Sin content_type, el tipo registrado se detecta del contenido.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest, private)
+    if not path.exists():
+        # Escritura atómica: nunca se sirve un blob a medio escribir
+        with new_blob_tempfile() as tmp:
+            tmp.write(data)
+        commit_blob_file(tmp.name, digest, private)
+    record_blob_type(digest, content_type or sniff_content_type(path), private)
+    return digest
+
+async def save_blob(data: bytes) -> Optional[str]:
+    """Guarda el contenido y devuelve su URL, o None si no es un formato permitido"""
+    digest = await asyncio.to_thread(write_blob, data)
+    content_type = await asyncio.to_thread(read_blob_type, digest)
+    return blob_url(digest, content_type) if content_type else None
+
+async def store_upload_file(file: UploadFile, limit: dict, private: bool = False):
+    """Guarda un archivo subido en el almacén de blobs; devuelve (SHA-256, tipo detectado).
+
+    Lee por bloques, calculando el hash y escribiendo en disco a la vez, de
+    modo que la memoria usada no depende del tamaño del archivo.
+    """
+    declared_type = (file.content_type or '').split(';')[0].strip().lower()
+    if declared_type not in limit["types"]:
+        raise HTTPException(status_code=415, detail="Tipo de archivo no permitido")
+    
+    hasher = hashlib.sha256()
+    size = 0
+    tmp = await asyncio.to_thread(new_blob_tempfile)
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit["max_bytes"]:
+                raise HTTPException(status_code=413, detail="El archivo es demasiado grande")
+            hasher.update(chunk)
+            await asyncio.to_thread(tmp.write, chunk)
+        await asyncio.to_thread(tmp.close)
+        # El tipo declarado no basta: se comprueba con los primeros bytes antes de guardar
+        content_type = await asyncio.to_thread(sniff_content_type, tmp.name)
+        if content_type not in limit["types"]:
+            raise HTTPException(status_code=415, detail="Tipo de archivo no permitido")
+        digest = hasher.hexdigest()
+        await asyncio.to_thread(commit_blob_file, tmp.name, digest, private)
+        await asyncio.to_thread(record_blob_type, digest, content_type, private)
+    except BaseException:
+        tmp.close()
+        if os.path.exists(tmp.name):
+            os.unlink(tmp.name)
+        raise
+    return digest, content_type
+
+async def store_upload(file: UploadFile, limit: dict) -> str:
+    """Guarda un archivo subido en el almacén público y devuelve su URL"""
+    return blob_url(*await store_upload_file(file, limit))
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadLimitMiddleware:
+    """Rechaza con 413 las subidas que exceden el límite de su ruta antes de parsear el multipart"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = None
+        if scope["type"] == "http" and scope["method"] in ("POST", "PUT"):
+            limit = next((l for pattern, l in UPLOAD_ROUTES if pattern.match(scope["path"])), None)
+        if limit is None:
+            return await self.app(scope, receive, send)
+        
+        max_body = limit["max_bytes"] + UPLOAD_MULTIPART_OVERHEAD
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body:
+            return await self.reject(send)
+        
+        # Sin Content-Length (chunked) se cuenta mientras se recibe; si se excede,
+        # cualquier respuesta del app (p. ej. el 400 de FastAPI al fallar el
+        # parseo) se reemplaza por el 413
+        received = 0
+        exceeded = False
+        rejected = False
+        
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    exceeded = True
+                    raise UploadTooLarge()
+            return message
+        
+        async def guarded_send(message):
+            nonlocal rejected
+            if not exceeded:
+                return await send(message)
+            if message["type"] == "http.response.start" and not rejected:
+                rejected = True
+                await self.reject(send)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            if not rejected:
+                rejected = True
+                await self.reject(send)
+
+    @staticmethod
+    async def reject(send):
+        body = json.dumps({"detail": "El archivo es demasiado grande"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+def parse_range_header(range_header: str, size: int):
+    """Devuelve (inicio, fin) inclusivos para un único rango bytes=, None si se ignora"""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        length = int(match.group(2))
+        if length == 0:
+            raise HTTPException(status_code=416, detail="Rango no satisfacible", headers={"Content-Range": f"bytes */{size}"})
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Rango no satisfacible", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+async def iter_file_range(path: Path, start: int, end: int, chunk_size: int = 64 * 1024):
+    with open(path, 'rb') as f:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def blob_digest_from_url(url: Optional[str]) -> Optional[str]:
+    if not url or not url.startswith(BLOB_BASE_URL + '/'):
+        return None
+    match = BLOB_NAME_RE.match(url[len(BLOB_BASE_URL) + 1:])
+    return match.group(1) if match else None
+
+def render_image_variants(digest: str) -> dict:
+    """Genera las variantes de una imagen del almacén; se ejecuta en el pool de imágenes.
+
+    Devuelve un mapa estilo srcset por formato, p. ej.
+    {"webp": "<url> 320w, <url> 640w", "jpeg": "..."}.
+    """
+    with Image.open(blob_path(digest)) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    
+    srcset = {name: [] for name in IMAGE_VARIANT_FORMATS}
+    rendered_widths = set()
+    for width in sorted(IMAGE_VARIANT_WIDTHS.values()):
+        # Nunca se amplía: si la original es más chica solo se genera una vez
+        target = min(width, image.width)
+        if target in rendered_widths:
+            continue
+        rendered_widths.add(target)
+        height = max(1, round(image.height * target / image.width))
+        resized = image if target == image.width else image.resize((target, height), Image.LANCZOS)
+        for name, (pil_format, content_type) in IMAGE_VARIANT_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, quality=80, optimize=True)
+            variant_digest = write_blob(buffer.getvalue(), content_type)
+            srcset[name].append(f"{blob_url(variant_digest, content_type)} {target}w")
+    return {name: ", ".join(entries) for name, entries in srcset.items()}
+
+def start_image_executor():
+    global image_executor
+    if image_executor is None:
+        image_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+
+def stop_image_executor():
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=True, cancel_futures=True)
+        image_executor = None
+
+async def generate_image_variants(collection: str, doc_id: str, field: str, url: str):
+    """Genera las variantes fuera del request y las guarda en <field>_srcset"""
+    digest = blob_digest_from_url(url)
+    if not digest:
+        return
+    try:
+        start_image_executor()
+        loop = asyncio.get_running_loop()
+        srcset = await loop.run_in_executor(image_executor, render_image_variants, digest)
     except Exception as e:
-        logging.error(f"Error en job de recordatorios: {str(e)}")
+        logging.error(f"Error generando variantes de {collection}.{field} de {doc_id}: {str(e)}")
+        return
+    # Solo si la imagen no fue reemplazada mientras se procesaba
+    await db[collection].update_one(
+        {"id": doc_id, field: url},
+        {"$set": {f"{field}_srcset": srcset}}
+    )
+    catalog_cache.bump("services", "packages", "gallery")
+
+def queue_image_variants(collection: str, doc_id: str, field: str, url: str):
+    spawn_background_task(generate_image_variants(collection, doc_id, field, url))
+
+async def rerender_image_variants():
+    """Regenera las variantes de todas las imágenes del catálogo ya guardadas"""
+    fields = {"services": ["imagen_url"], "gallery": ["imagen_antes", "imagen_despues"]}
+    rendered = 0
+    for collection, names in fields.items():
+        for name in names:
+            cursor = db[collection].find({name: {"$regex": f"^{re.escape(BLOB_BASE_URL)}/"}}, {"_id": 0, "id": 1, name: 1})
+            async for doc in cursor:
+                await generate_image_variants(collection, doc["id"], name, doc[name])
+                rendered += 1
+    logging.info(f"Variantes de imagen regeneradas: {rendered}")
+
+async def migrate_data_urls_to_blobs():
+    """Mueve las imágenes embebidas como data: URL al almacén de blobs"""
+    fields = {
+        "services": ["imagen_url"],
+        "gallery": ["imagen_antes", "imagen_despues"]
+    }
+    migrated = 0
+    for collection, names in fields.items():
+        for name in names:
+            cursor = db[collection].find({name: {"$regex": "^data:"}}, {"_id": 0, "id": 1, name: 1})
+            async for doc in cursor:
+                data_url = doc[name]
+                try:
+                    _, encoded = data_url.split(',', 1)
+                    # El tipo de la data: URL no se usa: se detecta del contenido
+                    url = await save_blob(base64.b64decode(encoded))
+                except Exception as e:
+                    logging.error(f"No se pudo migrar {collection}.{name} de {doc.get('id')}: {str(e)}")
+                    continue
+                if url is None:
+                    logging.error(f"No se migró {collection}.{name} de {doc.get('id')}: formato no permitido")
+                    continue
+                await db[collection].update_one({"id": doc["id"], name: data_url}, {"$set": {name: url}})
+                migrated += 1
+    catalog_cache.bump("services", "packages", "gallery")
+    logging.info(f"Imágenes migradas al almacén de blobs: {migrated}")
+
+def read_proof_source(url: str) -> bytes:
+    digest = blob_digest_from_url(url)
+    if digest:
+        return blob_path(digest).read_bytes()
+    _, encoded = url.split(',', 1)
+    return base64.b64decode(encoded)
+
+def remove_public_blob(digest: str):
+    for path in (blob_path(digest), blob_type_path(digest)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+async def privatize_payment_proofs():
+    """Pasa al almacén privado los comprobantes guardados como blob público o data: URL.
+
+    La copia pública se borra después de mover todas las citas que la usan,
+    salvo que alguna imagen del catálogo tenga el mismo contenido.
+    """
+    cursor = db.appointments.find(
+        {"comprobante_pago": {"$regex": f"^(data:|{re.escape(BLOB_BASE_URL)}/)"}},
+        {"_id": 0, "id": 1, "comprobante_pago": 1}
+    )
+    moved = 0
+    public_digests = set()
+    async for apt in cursor:
+        url = apt["comprobante_pago"]
+        try:
+            data = await asyncio.to_thread(read_proof_source, url)
+            digest = await asyncio.to_thread(write_blob, data, None, True)
+            content_type = await asyncio.to_thread(read_blob_type, digest, True)
+        except Exception as e:
+            logging.error(f"No se pudo mover el comprobante de {apt['id']}: {str(e)}")
+            continue
+        if content_type not in PROOF_UPLOAD_LIMIT["types"]:
+            logging.error(f"No se movió el comprobante de {apt['id']}: formato no permitido")
+            continue
+        await db.appointments.update_one(
+            {"id": apt["id"], "comprobante_pago": url},
+            {"$set": {"comprobante_pago": proof_path(apt["id"]), "comprobante_blob": digest, "comprobante_tipo": content_type}}
+        )
+        public_digest = blob_digest_from_url(url)
+        if public_digest:
+            public_digests.add(public_digest)
+        moved += 1
+    
+    for digest in public_digests:
+        pattern = {"$regex": f"/{digest}"}
+        in_catalog = await db.services.find_one({"imagen_url": pattern}, {"_id": 1}) or \
+            await db.gallery.find_one({"$or": [{"imagen_antes": pattern}, {"imagen_despues": pattern}]}, {"_id": 1})
+        if not in_catalog:
+            await asyncio.to_thread(remove_public_blob, digest)
+    logging.info(f"Comprobantes movidos al almacén privado: {moved}")
+
+class CatalogCache:
+    """Respuestas ya serializadas de los endpoints públicos del catálogo.
+
+    Cada endpoint tiene un contador de versión que los handlers de admin
+    incrementan al escribir; una entrada solo se guarda si la versión no
+    cambió mientras se consultaba Mongo.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.versions = {}
+        self.entries = {}
+
+    def bump(self, *names: str):
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+            self.entries.pop(name, None)
+
+    @staticmethod
+    def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+        if not if_none_match:
+            return False
+        candidates = [c.strip() for c in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
+
+    async def respond(self, name: str, request: Request, loader, expires_at_for=None) -> Response:
+        now = time.time()
+        entry = self.entries.get(name)
+        if entry is None or entry["expires_at"] <= now:
+            version = self.versions.get(name, 0)
+            data = await loader()
+            body = json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            expires_at = now + self.ttl
+            if expires_at_for is not None:
+                expires_at = min(expires_at, expires_at_for(data))
+            entry = {
+                "body": body,
+                "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+                "expires_at": expires_at
+            }
+            if self.versions.get(name, 0) == version:
+                self.entries[name] = entry
+        
+        headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+        if self.etag_matches(request.headers.get("if-none-match"), entry["etag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL)
+
+def blob_response(path: Path, content_type: str, filename: str, request: Request, cache_control: str) -> Response:
+    """Respuesta de un blob con el tipo registrado al subirlo, con soporte de ETag y Range.
+
+    nosniff impide que el navegador adivine otro tipo, y los formatos que no
+    son imagen se descargan en lugar de abrirse en el origen de la API.
+    """
+    disposition = "inline" if content_type.startswith("image/") else "attachment"
+    etag = f'"{path.name}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+        "Content-Disposition": f'{disposition}; filename="{filename}"'
+    }
+    if CatalogCache.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    size = path.stat().st_size
+    range_header = request.headers.get("range")
+    byte_range = parse_range_header(range_header, size) if range_header else None
+    if byte_range is None:
+        # FileResponse usa sendfile (zerocopysend) cuando el servidor lo soporta
+        return FileResponse(path, media_type=content_type, headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file_range(path, start, end), status_code=206, media_type=content_type, headers=headers)
+
+@api_router.get("/blobs/{blob_name}")
+async def get_blob(blob_name: str, request: Request):
+    match = BLOB_NAME_RE.match(blob_name)
+    if not match:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    digest = match.group(1)
+    path = blob_path(digest)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    
+    # Se sirve solo el tipo detectado al subirlo; una extensión que no le corresponde no existe
+    content_type = await asyncio.to_thread(read_blob_type, digest)
+    extension = (match.group(2) or "").lower()
+    if content_type is None or (extension and extension not in mimetypes.guess_all_extensions(content_type)):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    filename = f"{digest}{extension or mimetypes.guess_extension(content_type) or ''}"
+    return blob_response(path, content_type, filename, request, "public, max-age=31536000, immutable")
+
+def proof_path(appointment_id: str) -> str:
+    return f"/api/appointments/{appointment_id}/proof"
+
+def sign_proof(appointment_id: str, expires: int) -> str:
+    message = f"proof:{appointment_id}:{expires}".encode()
+    return hmac.new(JWT_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+def signed_proof_url(appointment_id: str) -> str:
+    """URL del comprobante que vale sin token Bearer (para <img>) durante PROOF_URL_TTL a 2*PROOF_URL_TTL.
+
+    El vencimiento se redondea a ventanas de PROOF_URL_TTL para que la URL no
+    cambie en cada consulta y el navegador pueda reutilizar su copia.
+    """
+    expires = (int(time.time()) // PROOF_URL_TTL + 2) * PROOF_URL_TTL
+    return f"{proof_path(appointment_id)}?exp={expires}&sig={sign_proof(appointment_id, expires)}"
+
+@api_router.get("/appointments/{appointment_id}/proof")
+async def get_payment_proof(
+    appointment_id: str,
+    request: Request,
+    exp: Optional[int] = None,
+    sig: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Comprobante de pago de una cita, solo para su cliente o el admin (token Bearer o URL firmada)"""
+    appointment = await db.appointments.find_one(
+        {"id": appointment_id},
+        {"_id": 0, "user_id": 1, "comprobante_blob": 1}
+    )
+    signed = exp is not None and sig is not None and exp > time.time() and hmac.compare_digest(sig, sign_proof(appointment_id, exp))
+    if not signed:
+        if credentials is None:
+            raise HTTPException(status_code=401, detail="No autenticado")
+        user = await get_current_user(credentials)
+        if user["role"] != "admin" and (not appointment or appointment["user_id"] != user["user_id"]):
+            raise HTTPException(status_code=404, detail="Comprobante no encontrado")
+    if not appointment or not appointment.get("comprobante_blob"):
+        raise HTTPException(status_code=404, detail="Comprobante no encontrado")
+    
+    digest = appointment["comprobante_blob"]
+    path = blob_path(digest, private=True)
+    content_type = await asyncio.to_thread(read_blob_type, digest, True) if path.is_file() else None
+    if content_type is None:
+        raise HTTPException(status_code=404, detail="Comprobante no encontrado")
+    filename = f"comprobante-{appointment_id}{mimetypes.guess_extension(content_type) or ''}"
+    return blob_response(path, content_type, filename, request, "private, no-cache")
 
 @api_router.post("/auth/register")
 async def register(user_data: UserRegister):
@@ -286,7 +1620,7 @@ async def register(user_data: UserRegister):
     user_dict = {
         "id": str(uuid.uuid4()),
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password_async(user_data.password),
         "nombre": user_data.nombre,
         "telefono": user_data.telefono,
         "role": user_data.role,
@@ -309,7 +1643,7 @@ async def register(user_data: UserRegister):
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password_async(credentials.password, user["password"], user["id"]):
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
     token = create_token(user["id"], user["email"], user["role"])
@@ -350,7 +1684,7 @@ async def login_admin(credentials: AdminPhoneLogin):
     if not user:
         raise HTTPException(status_code=401, detail="Administrador no encontrado")
     
-    if not verify_password(credentials.password, user["password"]):
+    if not await verify_password_async(credentials.password, user["password"], user["id"]):
         raise HTTPException(status_code=401, detail="Contraseña incorrecta")
     
     token = create_token(user["id"], user["email"], user["role"])
@@ -373,10 +1707,10 @@ async def change_password(password_data: ChangePassword, user = Depends(get_curr
     if not user_doc:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
-    if not verify_password(password_data.current_password, user_doc["password"]):
+    if not await verify_password_async(password_data.current_password, user_doc["password"]):
         raise HTTPException(status_code=400, detail="Contraseña actual incorrecta")
     
-    new_hashed = hash_password(password_data.new_password)
+    new_hashed = await hash_password_async(password_data.new_password)
     await db.users.update_one(
         {"id": user["user_id"]},
         {"$set": {"password": new_hashed, "is_temp_password": False}}
@@ -384,27 +1718,26 @@ async def change_password(password_data: ChangePassword, user = Depends(get_curr
     
     return {"message": "Contraseña actualizada exitosamente"}
 
-@api_router.get("/services")
-async def get_services():
-    services = await db.services.find({"activo": True}, {"_id": 0}).to_list(100)
+async def load_services():
+    # rating_promedio y total_reviews se mantienen al crear cada reseña
+    services = await db.services.find({"activo": True}, {"_id": 0, "rating_sum": 0, "rating_counts": 0}).to_list(100)
     
     for service in services:
-        reviews = await db.reviews.find({"service_id": service["id"]}, {"_id": 0}).to_list(1000)
-        if reviews:
-            avg_rating = sum(r["rating"] for r in reviews) / len(reviews)
-            service["rating_promedio"] = round(avg_rating, 1)
-            service["total_reviews"] = len(reviews)
-        else:
-            service["rating_promedio"] = 0
-            service["total_reviews"] = 0
+        service.setdefault("rating_promedio", 0)
+        service.setdefault("total_reviews", 0)
     
     return services
 
+@api_router.get("/services")
+async def get_services(request: Request):
+    return await catalog_cache.respond("services", request, load_services)
+
 @api_router.post("/services")
 async def create_service(service: ServiceCreate, user = Depends(get_admin_user)):
     service_dict = Service(**service.model_dump()).model_dump()
     service_dict["created_at"] = service_dict["created_at"].isoformat()
     await db.services.insert_one(service_dict)
+    catalog_cache.bump("services")
     return service_dict
 
 @api_router.put("/services/{service_id}")
@@ -415,6 +1748,8 @@ async def update_service(service_id: str, service: ServiceCreate, user = Depends
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    catalog_cache.bump("services", "packages", "gallery")
+    availability_cache.invalidate_service(service_id)
     return {"message": "Servicio actualizado"}
 
 @api_router.delete("/services/{service_id}")
@@ -425,58 +1760,132 @@ async def delete_service(service_id: str, user = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    catalog_cache.bump("services", "packages", "gallery")
     return {"message": "Servicio eliminado"}
 
 @api_router.post("/services/{service_id}/upload-image")
 async def upload_service_image(service_id: str, file: UploadFile = File(...), user = Depends(get_admin_user)):
-    contents = await file.read()
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    image_url = f"data:{file.content_type};base64,{base64_image}"
+    image_url = await store_upload(file, IMAGE_UPLOAD_LIMIT)
     
     result = await db.services.update_one(
         {"id": service_id},
-        {"$set": {"imagen_url": image_url}}
+        {"$set": {"imagen_url": image_url}, "$unset": {"imagen_url_srcset": ""}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Servicio no encontrado")
     
+    catalog_cache.bump("services", "packages", "gallery")
+    queue_image_variants("services", service_id, "imagen_url", image_url)
     return {"imagen_url": image_url}
 
+def encode_cursor(values: list) -> str:
+    """Cursor opaco para paginación por keyset"""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    return values
+
+def parse_date_param(value: str, name: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida en {name}, use AAAA-MM-DD")
+
+def fecha_range_filter(desde: Optional[str], hasta: Optional[str]) -> dict:
+    """Filtro sobre fecha (ISO sin zona, comparable como texto) para desde/hasta inclusivos"""
+    fecha_filter = {}
+    if desde:
+        fecha_filter["$gte"] = parse_date_param(desde, "desde").isoformat()
+    if hasta:
+        fecha_filter["$lt"] = (parse_date_param(hasta, "hasta") + timedelta(days=1)).isoformat()
+    return fecha_filter
+
 @api_router.get("/appointments")
-async def get_appointments(user = Depends(get_current_user)):
+async def get_appointments(
+    response: Response,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    estado: Optional[str] = None,
+    service_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    orden: str = Query("asc", pattern="^(asc|desc)$"),
+    limit: int = Query(1000, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    user = Depends(get_current_user),
+    loaders: DataLoaders = Depends(get_loaders)
+):
+    """Citas ordenadas por (fecha, id), paginadas por cursor (encabezado X-Next-Cursor)"""
+    query = {}
     if user["role"] == "admin":
-        appointments = await db.appointments.find({}, {"_id": 0}).to_list(1000)
+        if user_id:
+            query["user_id"] = user_id
     else:
-        appointments = await db.appointments.find({"user_id": user["user_id"]}, {"_id": 0}).to_list(1000)
-    
-    for apt in appointments:
-        service = await db.services.find_one({"id": apt["service_id"]}, {"_id": 0})
+        query["user_id"] = user["user_id"]
+    if service_id:
+        query["service_id"] = service_id
+    if estado:
+        query["estado"] = estado
+    fecha_filter = fecha_range_filter(desde, hasta)
+    if fecha_filter:
+        query["fecha"] = fecha_filter
+    
+    direction = 1 if orden == "asc" else -1
+    if cursor:
+        last_fecha, last_id = decode_cursor(cursor, 2)
+        op = "$gt" if direction == 1 else "$lt"
+        query = {"$and": [query, {"$or": [
+            {"fecha": {op: last_fecha}},
+            {"fecha": last_fecha, "id": {op: last_id}}
+        ]}]}
+    
+    appointments = await db.appointments.find(query, {"_id": 0}).sort(
+        [("fecha", direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    if len(appointments) > limit:
+        appointments = appointments[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor([appointments[-1]["fecha"], appointments[-1]["id"]])
+    
+    services = await loaders.services.load_many([apt["service_id"] for apt in appointments])
+    for apt, service in zip(appointments, services):
         apt["service"] = service
-        
-        if user["role"] == "admin":
-            user_data = await db.users.find_one({"id": apt["user_id"]}, {"_id": 0, "password": 0})
+        if apt.pop("comprobante_blob", None):
+            apt["comprobante_pago"] = signed_proof_url(apt["id"])
+    
+    if user["role"] == "admin":
+        users = await loaders.users.load_many([apt["user_id"] for apt in appointments])
+        for apt, user_data in zip(appointments, users):
             apt["user"] = user_data
-        
-        apt["can_review"] = (
-            apt["estado"] == "confirmada" and 
-            datetime.fromisoformat(apt["fecha"]) < datetime.now(timezone.utc) and
-            not await db.reviews.find_one({"appointment_id": apt["id"]})
-        )
+    
+    # fecha es hora local sin zona: se compara con la hora del negocio, no con UTC
+    now = business_now()
+    review_candidates = [
+        apt for apt in appointments
+        if apt["estado"] == "confirmada" and datetime.fromisoformat(apt["fecha"]) < now
+    ]
+    reviews = await loaders.reviews_by_appointment.load_many([apt["id"] for apt in review_candidates])
+    reviewable = {apt["id"] for apt, review in zip(review_candidates, reviews) if not review}
+    for apt in appointments:
+        apt["can_review"] = apt["id"] in reviewable
     
     return appointments
 
 @api_router.post("/appointments")
 async def create_appointment(appointment: AppointmentCreate, user = Depends(get_current_user)):
     fecha_hora = datetime.fromisoformat(f"{appointment.fecha}T{appointment.hora}")
+    duration = await get_service_duration(appointment.service_id)
     
-    existing = await db.appointments.find_one({
-        "service_id": appointment.service_id,
-        "fecha": fecha_hora.isoformat(),
-        "estado": {"$ne": "cancelada"}
-    })
-    
-    if existing:
+    # Se compara el intervalo completo [inicio, inicio + duración), no solo la hora exacta
+    occupancy = await load_day_occupancy(appointment.service_id, fecha_hora.date(), duration, fresh=True)
+    if not occupancy.is_free(fecha_hora.hour * 60 + fecha_hora.minute):
         raise HTTPException(status_code=400, detail="Esta hora ya está reservada")
     
     apt_dict = {
@@ -484,13 +1893,25 @@ async def create_appointment(appointment: AppointmentCreate, user = Depends(get_
         "user_id": user["user_id"],
         "service_id": appointment.service_id,
         "fecha": fecha_hora.isoformat(),
+        "duracion": duration,
         "estado": "pendiente",
         "reminder_sent": False,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
+    # La reserva atómica del horario decide entre solicitudes simultáneas
+    await claim_slots(apt_dict["id"], appointment.service_id, fecha_hora, duration)
+    
     # Insertar en BD (esto modifica apt_dict agregando _id)
-    await db.appointments.insert_one(apt_dict.copy())
+    try:
+        await db.appointments.insert_one(apt_dict.copy())
+    except Exception:
+        await release_slots(apt_dict["id"])
+        raise
+    await confirm_slots(apt_dict["id"])
+    availability_cache.mark_booked(appointment.service_id, apt_dict)
+    reminder_timers.schedule(apt_dict)
+    stats_memo.invalidate()
     
     user_data = await db.users.find_one({"id": user["user_id"]}, {"_id": 0})
     service = await db.services.find_one({"id": appointment.service_id}, {"_id": 0})
@@ -526,7 +1947,7 @@ Te enviaremos un recordatorio 24h antes de tu cita.
 
 ¡Gracias por confiar en nosotros! ✨"""
         
-        send_notification(user_data["telefono"], message, prefer_whatsapp=True)
+        await send_notification(user_data["telefono"], message, prefer_whatsapp=True)
     
     # Retornar copia sin _id
     return {
@@ -534,59 +1955,392 @@ Te enviaremos un recordatorio 24h antes de tu cita.
         "user_id": apt_dict["user_id"],
         "service_id": apt_dict["service_id"],
         "fecha": apt_dict["fecha"],
+        "duracion": apt_dict["duracion"],
         "estado": apt_dict["estado"],
         "reminder_sent": apt_dict["reminder_sent"],
         "created_at": apt_dict["created_at"]
     }
 
+async def record_confirmation_change(apt: dict, delta: int):
+    """Suma (delta=1) o resta (delta=-1) una cita confirmada en el rollup de su día y servicio"""
+    dia = apt["fecha"][:10]
+    await db.stats_daily.update_one(
+        {"dia": dia, "service_id": apt["service_id"]},
+        {
+            "$inc": {
+                "confirmadas": delta,
+                "ingresos": delta * (apt.get("precio") or 0),
+                f"horas.{apt['fecha'][11:13]}": delta
+            },
+            "$setOnInsert": {"mes": dia[:7], "dia_semana": date.fromisoformat(dia).isoweekday()}
+        },
+        upsert=True
+    )
+
+async def set_appointment_estado(
+    appointment: dict,
+    estado: str,
+    extra: Optional[dict] = None,
+    from_estados: Optional[List[str]] = None
+) -> Optional[dict]:
+    """Cambia el estado de una cita y mantiene stats_daily si entra o sale de confirmada.
+
+    Con from_estados el cambio solo se aplica si la cita está en uno de ellos.
+    Devuelve la cita como estaba antes del cambio, o None si no se aplicó.
+    """
+    update = {"estado": estado, **(extra or {})}
+    if estado == "confirmada":
+        # El precio se congela al confirmar: es el que el rollup suma y, si se cancela, resta
+        service = await db.services.find_one({"id": appointment["service_id"]}, {"_id": 0, "precio": 1})
+        update["precio"] = service["precio"] if service else 0
+    
+    # El filtro por estado hace que solo una petición concurrente vea cada transición
+    before = await db.appointments.find_one_and_update(
+        {"id": appointment["id"], "estado": {"$in": from_estados} if from_estados else {"$ne": estado}},
+        {"$set": update},
+        projection={"_id": 0, "id": 1, "service_id": 1, "fecha": 1, "estado": 1, "precio": 1}
+    )
+    if before is None:
+        return None
+    
+    stats_memo.invalidate()
+    if estado == "confirmada":
+        await record_confirmation_change({**before, "precio": update["precio"]}, 1)
+    elif before["estado"] == "confirmada":
+        await record_confirmation_change(before, -1)
+    return before
+
 @api_router.post("/appointments/{appointment_id}/upload-proof")
 async def upload_payment_proof(appointment_id: str, file: UploadFile = File(...), user = Depends(get_current_user)):
     appointment = await db.appointments.find_one({"id": appointment_id, "user_id": user["user_id"]}, {"_id": 0})
     
     if not appointment:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
+    # Su horario ya se liberó: confirmarla la reactivaría sin reservarlo
+    if appointment["estado"] == "cancelada":
+        raise HTTPException(status_code=409, detail="La cita está cancelada")
+    
+    # El comprobante va al almacén privado: solo se sirve por get_payment_proof
+    digest, content_type = await store_upload_file(file, PROOF_UPLOAD_LIMIT, private=True)
+    proof = {
+        "comprobante_pago": proof_path(appointment_id),
+        "comprobante_blob": digest,
+        "comprobante_tipo": content_type
+    }
     
-    contents = await file.read()
-    base64_proof = base64.b64encode(contents).decode('utf-8')
-    proof_url = f"data:{file.content_type};base64,{base64_proof}"
-    
-    await db.appointments.update_one(
-        {"id": appointment_id},
-        {"$set": {"comprobante_pago": proof_url, "estado": "confirmada"}}
-    )
+    changed = await set_appointment_estado(appointment, "confirmada", proof, from_estados=["pendiente"])
+    if changed is None:
+        # Ya estaba confirmada o completada: solo se reemplaza el comprobante
+        result = await db.appointments.update_one(
+            {"id": appointment_id, "estado": {"$ne": "cancelada"}},
+            {"$set": proof}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=409, detail="La cita está cancelada")
     
-    return {"message": "Comprobante subido exitosamente", "comprobante_url": proof_url}
+    return {"message": "Comprobante subido exitosamente", "comprobante_url": signed_proof_url(appointment_id)}
+
+async def reactivate_appointment(appointment: dict, estado: str):
+    """Pasa una cita cancelada a un estado activo y vuelve a reservar su horario, si sigue libre.
+
+    La transición se aplica primero, condicionada a que siga cancelada: entre
+    peticiones simultáneas solo una la gana y solo esa reserva los bloques.
+    Si el horario ya es de otra cita, la cita vuelve a cancelada.
+    """
+    if await set_appointment_estado(appointment, estado, from_estados=["cancelada"]) is None:
+        raise HTTPException(status_code=409, detail="La cita ya no está cancelada")
+    duration = appointment.get("duracion") or await get_service_duration(appointment["service_id"])
+    try:
+        await claim_slots(appointment["id"], appointment["service_id"], datetime.fromisoformat(appointment["fecha"]), duration)
+    except HTTPException:
+        await set_appointment_estado({**appointment, "estado": estado}, "cancelada", from_estados=[estado])
+        raise
+    await confirm_slots(appointment["id"])
 
 @api_router.put("/appointments/{appointment_id}/status")
 async def update_appointment_status(appointment_id: str, estado: str = Form(...), user = Depends(get_admin_user)):
-    result = await db.appointments.update_one(
+    appointment = await db.appointments.find_one(
         {"id": appointment_id},
-        {"$set": {"estado": estado}}
+        {"_id": 0, "id": 1, "service_id": 1, "fecha": 1, "duracion": 1, "estado": 1, "reminder_sent": 1}
     )
     
-    if result.matched_count == 0:
+    if appointment is None:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
     
+    if appointment["estado"] == "cancelada" and estado != "cancelada":
+        await reactivate_appointment(appointment, estado)
+    elif estado == "cancelada":
+        if await set_appointment_estado(appointment, estado):
+            await release_slots(appointment_id)
+    else:
+        # Sin pasar por cancelada: una cita cancelada entretanto no se reactiva sin reservar su horario
+        changed = await set_appointment_estado(appointment, estado, from_estados=[s for s in ACTIVE_STATES if s != estado])
+        if changed is None and await db.appointments.find_one({"id": appointment_id, "estado": "cancelada"}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="La cita fue cancelada")
+    
+    # Cancelar o completar quita el temporizador del recordatorio; reactivar lo vuelve a programar
+    reminder_timers.schedule({**appointment, "estado": estado})
+    
+    # Al cancelar o reactivar cambia la ocupación del día: se recalcula en la próxima consulta
+    availability_cache.invalidate(appointment["service_id"], datetime.fromisoformat(appointment["fecha"]).date())
     return {"message": "Estado actualizado"}
 
-@api_router.get("/availability")
-async def get_availability(service_id: str, fecha: str):
-    fecha_dt = datetime.fromisoformat(fecha)
-    appointments = await db.appointments.find({
+class DayOccupancy:
+    """Ocupación de un servicio en un día.
+
+    Guarda los intervalos [inicio, inicio + duración) de las citas activas y
+    un bitmap, calculado bajo demanda, de los slots de SLOT_TEMPLATE donde ya
+    no cabe una cita del servicio.
+    """
+
+    __slots__ = ("slots", "duration", "busy", "bitmap", "expires_at")
+
+    def __init__(self, slots: List[str], duration: int, expires_at: float):
+        self.slots = [minute_of_day(slot) for slot in slots]
+        self.duration = duration
+        self.busy = BusyIntervals()
+        self.bitmap = None
+        self.expires_at = expires_at
+
+    def add(self, start: int, duration: int):
+        self.busy.add(start, start + duration)
+        self.bitmap = None
+
+    def add_appointment(self, apt: dict):
+        apt_date = datetime.fromisoformat(apt["fecha"])
+        self.add(apt_date.hour * 60 + apt_date.minute, apt.get("duracion") or self.duration)
+
+    def is_free(self, start: int) -> bool:
+        return not self.busy.overlaps(start, start + self.duration)
+
+    def blocked_bitmap(self) -> int:
+        if self.bitmap is None:
+            self.bitmap = 0
+            for i, start in enumerate(self.slots):
+                if not self.is_free(start):
+                    self.bitmap |= 1 << i
+        return self.bitmap
+
+    def occupied_hours(self) -> List[str]:
+        bitmap = self.blocked_bitmap()
+        return [format_minute(start) for i, start in enumerate(self.slots) if bitmap >> i & 1]
+
+    def available_hours(self) -> List[str]:
+        bitmap = self.blocked_bitmap()
+        return [format_minute(start) for i, start in enumerate(self.slots) if not bitmap >> i & 1]
+
+class AvailabilityCache:
+    """LRU de ocupación por (service_id, día), mantenida al crear o cambiar citas"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, service_id: str, day: date) -> Optional[DayOccupancy]:
+        key = (service_id, day)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, service_id: str, day: date, occupancy: DayOccupancy):
+        self.entries[(service_id, day)] = occupancy
+        self.entries.move_to_end((service_id, day))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def mark_booked(self, service_id: str, apt: dict):
+        entry = self.get(service_id, datetime.fromisoformat(apt["fecha"]).date())
+        if entry is not None:
+            entry.add_appointment(apt)
+
+    def invalidate(self, service_id: str, day: date):
+        self.entries.pop((service_id, day), None)
+
+    def invalidate_service(self, service_id: str):
+        for key in [key for key in self.entries if key[0] == service_id]:
+            del self.entries[key]
+
+availability_cache = AvailabilityCache(AVAILABILITY_CACHE_SIZE, AVAILABILITY_CACHE_TTL)
+
+def day_range_filter(day: date) -> dict:
+    return {"$gte": day.isoformat(), "$lt": (day + timedelta(days=1)).isoformat()}
+
+async def get_service_duration(service_id: str) -> int:
+    service = await db.services.find_one({"id": service_id}, {"_id": 0, "duracion": 1})
+    if not service:
+        raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    return service["duracion"]
+
+async def load_occupancy_range(service_id: str, duration: int, start: date, end: date) -> dict:
+    """Ocupación de cada día entre start y end (inclusive) con una sola consulta por rango"""
+    expires_at = time.time() + AVAILABILITY_CACHE_TTL
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    occupancy = {day: DayOccupancy(SLOT_TEMPLATE[day.weekday()], duration, expires_at) for day in days}
+    # Rango sobre el índice (service_id, fecha, id)
+    cursor = db.appointments.find({
         "service_id": service_id,
+        "fecha": {"$gte": start.isoformat(), "$lt": (end + timedelta(days=1)).isoformat()},
         "estado": {"$ne": "cancelada"}
-    }, {"_id": 0}).to_list(1000)
-    
-    occupied_hours = []
-    for apt in appointments:
-        apt_date = datetime.fromisoformat(apt["fecha"])
-        if apt_date.date() == fecha_dt.date():
-            occupied_hours.append(apt_date.strftime("%H:%M"))
-    
-    return {"occupied_hours": occupied_hours}
+    }, {"_id": 0, "fecha": 1, "duracion": 1})
+    async for apt in cursor:
+        occupancy[datetime.fromisoformat(apt["fecha"]).date()].add_appointment(apt)
+    for day in days:
+        availability_cache.put(service_id, day, occupancy[day])
+    return occupancy
+
+async def load_day_occupancy(service_id: str, day: date, duration: Optional[int] = None, fresh: bool = False) -> DayOccupancy:
+    if not fresh:
+        occupancy = availability_cache.get(service_id, day)
+        if occupancy is not None:
+            return occupancy
+    if duration is None:
+        duration = await get_service_duration(service_id)
+    return (await load_occupancy_range(service_id, duration, day, day))[day]
+
+def slot_claim_keys(fecha_hora: datetime, duration: int) -> List[str]:
+    """Bloques de SLOT_CLAIM_MINUTES que cubren [inicio, inicio + duración), redondeando hacia afuera"""
+    day_start = datetime.combine(fecha_hora.date(), datetime.min.time())
+    start = fecha_hora.hour * 60 + fecha_hora.minute
+    first = start - start % SLOT_CLAIM_MINUTES
+    return [
+        (day_start + timedelta(minutes=minute)).isoformat()
+        for minute in range(first, start + duration, SLOT_CLAIM_MINUTES)
+    ]
+
+async def release_slots(appointment_id: str):
+    await db.slot_claims.delete_many({"appointment_id": appointment_id})
+
+async def claim_slots(appointment_id: str, service_id: str, fecha_hora: datetime, duration: int):
+    """Reserva atómicamente los bloques de la cita; el índice único (service_id, slot) impide dos reservas solapadas.
+
+    Los bloques quedan pendientes hasta confirm_slots; los que nunca se
+    confirman (el proceso cayó antes de guardar la cita) vencen por TTL.
+    """
+    pending_until = datetime.now(timezone.utc) + timedelta(seconds=SLOT_CLAIM_PENDING_SECONDS)
+    claims = [
+        {"service_id": service_id, "slot": slot, "appointment_id": appointment_id, "pending_until": pending_until}
+        for slot in slot_claim_keys(fecha_hora, duration)
+    ]
+    try:
+        await db.slot_claims.insert_many(claims, ordered=True)
+    except (BulkWriteError, DuplicateKeyError) as e:
+        # Se liberan solo los bloques que insertó esta llamada (ordered: los primeros nInserted)
+        inserted = (e.details or {}).get("nInserted", 0) if isinstance(e, BulkWriteError) else 0
+        if inserted:
+            await db.slot_claims.delete_many({
+                "service_id": service_id,
+                "slot": {"$in": [claim["slot"] for claim in claims[:inserted]]},
+                "appointment_id": appointment_id
+            })
+        raise HTTPException(status_code=400, detail="Esta hora ya está reservada")
 
-@api_router.get("/promotions")
-async def get_promotions():
+async def confirm_slots(appointment_id: str):
+    """Marca como definitivos los bloques de una cita ya guardada"""
+    await db.slot_claims.update_many(
+        {"appointment_id": appointment_id, "pending_until": {"$exists": True}},
+        {"$unset": {"pending_until": ""}}
+    )
+
+async def backfill_slot_claims():
+    """Reconcilia slot_claims con las citas (idempotente).
+
+    Crea o confirma los bloques de las citas activas y borra los confirmados
+    cuya cita no existe o está cancelada. Los pendientes son reservas en
+    curso y no se tocan: si quedaron huérfanos, el TTL los borra.
+    """
+    claimed = conflicts = 0
+    cursor = db.appointments.find({"estado": {"$ne": "cancelada"}}, {"_id": 0, "id": 1, "service_id": 1, "fecha": 1, "duracion": 1})
+    async for apt in cursor:
+        duration = apt.get("duracion") or await get_service_duration(apt["service_id"])
+        for slot in slot_claim_keys(datetime.fromisoformat(apt["fecha"]), duration):
+            try:
+                await db.slot_claims.update_one(
+                    {"service_id": apt["service_id"], "slot": slot, "appointment_id": apt["id"]},
+                    {"$unset": {"pending_until": ""}},
+                    upsert=True
+                )
+                claimed += 1
+            except DuplicateKeyError:
+                # El bloque es de otra cita
+                conflicts += 1
+    
+    orphans = await db.slot_claims.aggregate([
+        {"$match": {"pending_until": {"$exists": False}}},
+        {"$group": {"_id": "$appointment_id"}},
+        {"$lookup": {
+            "from": "appointments",
+            "localField": "_id",
+            "foreignField": "id",
+            "pipeline": [{"$match": {"estado": {"$ne": "cancelada"}}}, {"$project": {"_id": 1}}],
+            "as": "active"
+        }},
+        {"$match": {"active": []}}
+    ]).to_list(None)
+    result = await db.slot_claims.delete_many({
+        "appointment_id": {"$in": [orphan["_id"] for orphan in orphans]},
+        "pending_until": {"$exists": False}
+    })
+    logging.info(
+        f"slot_claims creados/verificados: {claimed}, conflictos: {conflicts}, "
+        f"huérfanos borrados: {result.deleted_count}"
+    )
+
+@api_router.get("/availability")
+async def get_availability(service_id: str, fecha: str):
+    fecha_dt = datetime.fromisoformat(fecha)
+    occupancy = await load_day_occupancy(service_id, fecha_dt.date())
+    return {"occupied_hours": occupancy.occupied_hours()}
+
+@api_router.get("/availability/range")
+async def get_availability_range(service_id: str, desde: str, hasta: str):
+    """Horas libres y ocupadas de cada día entre desde y hasta (inclusive) con una sola consulta"""
+    start = parse_date_param(desde, "desde")
+    end = parse_date_param(hasta, "hasta")
+    if end < start:
+        raise HTTPException(status_code=400, detail="hasta debe ser posterior a desde")
+    if (end - start).days + 1 > AVAILABILITY_RANGE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"El rango máximo es de {AVAILABILITY_RANGE_MAX_DAYS} días")
+    
+    duration = await get_service_duration(service_id)
+    occupancy = await load_occupancy_range(service_id, duration, start, end)
+    
+    result = []
+    for day, day_occupancy in occupancy.items():
+        result.append({
+            "fecha": day.isoformat(),
+            "available_hours": day_occupancy.available_hours(),
+            "occupied_hours": day_occupancy.occupied_hours()
+        })
+    return {"dias": result}
+
+@api_router.get("/availability/next")
+async def get_next_available(service_id: str, desde: Optional[str] = None, n: int = Query(1, ge=1, le=50)):
+    """Primeros n horarios libres a partir de desde (por defecto, ahora)"""
+    now = business_now()
+    start = parse_date_param(desde, "desde") if desde else now.date()
+    end = start + timedelta(days=AVAILABILITY_RANGE_MAX_DAYS - 1)
+    
+    duration = await get_service_duration(service_id)
+    occupancy = await load_occupancy_range(service_id, duration, start, end)
+    
+    slots = []
+    for day, day_occupancy in occupancy.items():
+        candidates = day_occupancy.slots
+        if day == now.date():
+            candidates = [m for m in candidates if m > now.hour * 60 + now.minute]
+        for minute in day_occupancy.busy.free_starts(candidates, duration, n - len(slots)):
+            slots.append({"fecha": day.isoformat(), "hora": format_minute(minute)})
+        if len(slots) >= n:
+            break
+    return {"slots": slots}
+
+async def load_promotions():
     now = datetime.now(timezone.utc).isoformat()
     promotions = await db.promotions.find({
         "activo": True,
@@ -594,6 +2348,23 @@ async def get_promotions():
     }, {"_id": 0}).to_list(100)
     return promotions
 
+def promotions_expire_at(promotions) -> float:
+    """Momento en que vence la primera promoción de la lista (fin de su vigencia)"""
+    expirations = []
+    for promo in promotions:
+        try:
+            fecha_fin = datetime.fromisoformat(promo["fecha_fin"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if fecha_fin.tzinfo is None:
+            fecha_fin = fecha_fin.replace(tzinfo=timezone.utc)
+        expirations.append(fecha_fin.timestamp())
+    return min(expirations, default=float("inf"))
+
+@api_router.get("/promotions")
+async def get_promotions(request: Request):
+    return await catalog_cache.respond("promotions", request, load_promotions, promotions_expire_at)
+
 @api_router.post("/promotions")
 async def create_promotion(promotion: PromotionCreate, user = Depends(get_admin_user)):
     promo_dict = {
@@ -608,6 +2379,7 @@ async def create_promotion(promotion: PromotionCreate, user = Depends(get_admin_
     }
     
     await db.promotions.insert_one(promo_dict)
+    catalog_cache.bump("promotions")
     return promo_dict
 
 @api_router.delete("/promotions/{promotion_id}")
@@ -618,6 +2390,7 @@ async def delete_promotion(promotion_id: str, user = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Promoción no encontrada")
+    catalog_cache.bump("promotions")
     return {"message": "Promoción eliminada"}
 
 @api_router.post("/reviews")
@@ -630,44 +2403,144 @@ async def create_review(review: ReviewCreate, user = Depends(get_current_user)):
     
     if not appointment:
         raise HTTPException(status_code=404, detail="Cita no encontrada o no confirmada")
+    service_id = appointment["service_id"]
+    if review.service_id is not None and review.service_id != service_id:
+        raise HTTPException(status_code=400, detail="El servicio no corresponde a la cita")
     
     existing = await db.reviews.find_one({"appointment_id": review.appointment_id})
     if existing:
         raise HTTPException(status_code=400, detail="Ya has dejado una reseña para esta cita")
     
+    # El nombre se guarda con la reseña para listarlas sin consultar usuarios
+    author = await db.users.find_one({"id": user["user_id"]}, {"_id": 0, "nombre": 1})
+    
     review_dict = {
         "id": str(uuid.uuid4()),
         "user_id": user["user_id"],
-        "service_id": review.service_id,
+        "user_nombre": author["nombre"] if author else "Usuario",
+        "service_id": service_id,
         "appointment_id": review.appointment_id,
         "rating": review.rating,
         "comentario": review.comentario,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_iso(datetime.now(timezone.utc))
     }
     
-    await db.reviews.insert_one(review_dict)
+    try:
+        await db.reviews.insert_one(review_dict)
+    except DuplicateKeyError:
+        # Otro envío simultáneo ganó: los agregados ya la cuentan
+        raise HTTPException(status_code=400, detail="Ya has dejado una reseña para esta cita")
+    
+    # Actualiza la suma/conteo, el histograma por estrellas y el promedio del servicio en una sola operación atómica
+    star = str(review.rating)
+    await db.services.update_one(
+        {"id": service_id},
+        [
+            {"$set": {
+                "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, review.rating]},
+                "total_reviews": {"$add": [{"$ifNull": ["$total_reviews", 0]}, 1]},
+                "rating_counts": {"$mergeObjects": [
+                    {"$ifNull": ["$rating_counts", {}]},
+                    {star: {"$add": [{"$ifNull": [f"$rating_counts.{star}", 0]}, 1]}}
+                ]}
+            }},
+            {"$set": {
+                "rating_promedio": {"$round": [{"$divide": ["$rating_sum", "$total_reviews"]}, 1]}
+            }}
+        ]
+    )
+    catalog_cache.bump("services", "packages", "gallery")
     return {"message": "Reseña creada exitosamente"}
 
+REVIEW_ORDERS = {
+    "recientes": ["created_at", "id"],
+    "rating": ["rating", "created_at", "id"]
+}
+
+def keyset_before(fields: List[str], values: list) -> dict:
+    """Filtro de las filas posteriores al cursor en un orden descendente por fields"""
+    return {"$or": [
+        {**{field: value for field, value in zip(fields[:i], values[:i])}, fields[i]: {"$lt": values[i]}}
+        for i in range(len(fields))
+    ]}
+
 @api_router.get("/reviews/{service_id}")
-async def get_service_reviews(service_id: str):
-    reviews = await db.reviews.find({"service_id": service_id}, {"_id": 0}).to_list(1000)
-    
-    for review in reviews:
-        user = await db.users.find_one({"id": review["user_id"]}, {"_id": 0, "password": 0})
-        review["user_nombre"] = user["nombre"] if user else "Usuario"
-    
-    return reviews
+async def get_service_reviews(
+    service_id: str,
+    response: Response,
+    orden: str = Query("recientes", pattern="^(recientes|rating)$"),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    formato: str = Query("lista", pattern="^(lista|resumen)$")
+):
+    """Reseñas de un servicio paginadas por cursor (X-Next-Cursor).
+
+    Por defecto responde la lista de reseñas, como antes de paginar; con
+    formato=resumen responde {total_reviews, rating_promedio, histograma,
+    reviews} con el histograma por estrellas.
+
+    Una sola consulta: el documento del servicio trae los agregados y un
+    $lookup trae la página de reseñas por el índice (service_id, orden).
+    """
+    fields = REVIEW_ORDERS[orden]
+    match = {"service_id": service_id}
+    if cursor:
+        match = {"$and": [match, keyset_before(fields, decode_cursor(cursor, len(fields)))]}
+    
+    result = await db.services.aggregate([
+        {"$match": {"id": service_id}},
+        {"$project": {"_id": 0, "total_reviews": 1, "rating_promedio": 1, "rating_counts": 1}},
+        {"$lookup": {
+            "from": "reviews",
+            "pipeline": [
+                {"$match": match},
+                {"$sort": {field: -1 for field in fields}},
+                {"$limit": limit + 1},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "reviews"
+        }}
+    ]).to_list(1)
+    if not result:
+        raise HTTPException(status_code=404, detail="Servicio no encontrado")
+    service = result[0]
+    
+    reviews = service["reviews"]
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor([reviews[-1][field] for field in fields])
+    
+    # Las reseñas creadas antes de guardar user_nombre lo buscan en users (una
+    # consulta $in por página) hasta correr manage.py backfill-review-names
+    missing = [review for review in reviews if "user_nombre" not in review]
+    if missing:
+        users = await DataLoaders().users.load_many([review["user_id"] for review in missing])
+        for review, user in zip(missing, users):
+            review["user_nombre"] = user["nombre"] if user else "Usuario"
+    
+    if formato == "lista":
+        return reviews
+    counts = service.get("rating_counts") or {}
+    return {
+        "total_reviews": service.get("total_reviews", 0),
+        "rating_promedio": service.get("rating_promedio", 0),
+        "histograma": {str(star): counts.get(str(star), 0) for star in range(1, 6)},
+        "reviews": reviews
+    }
 
-@api_router.get("/gallery")
-async def get_gallery():
+async def load_gallery():
     gallery_items = await db.gallery.find({"activo": True}, {"_id": 0}).to_list(100)
     
-    for item in gallery_items:
-        service = await db.services.find_one({"id": item["service_id"]}, {"_id": 0})
+    services = await DataLoaders().services.load_many([item["service_id"] for item in gallery_items])
+    for item, service in zip(gallery_items, services):
         item["service"] = service
     
     return gallery_items
 
+@api_router.get("/gallery")
+async def get_gallery(request: Request):
+    return await catalog_cache.respond("gallery", request, load_gallery)
+
 @api_router.post("/gallery")
 async def create_gallery_item(gallery: GalleryCreate, user = Depends(get_admin_user)):
     gallery_dict = {
@@ -682,38 +2555,39 @@ async def create_gallery_item(gallery: GalleryCreate, user = Depends(get_admin_u
     }
     
     await db.gallery.insert_one(gallery_dict)
+    catalog_cache.bump("gallery")
     return gallery_dict
 
 @api_router.post("/gallery/{gallery_id}/upload-before")
 async def upload_before_image(gallery_id: str, file: UploadFile = File(...), user = Depends(get_admin_user)):
-    contents = await file.read()
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    image_url = f"data:{file.content_type};base64,{base64_image}"
+    image_url = await store_upload(file, IMAGE_UPLOAD_LIMIT)
     
     result = await db.gallery.update_one(
         {"id": gallery_id},
-        {"$set": {"imagen_antes": image_url}}
+        {"$set": {"imagen_antes": image_url}, "$unset": {"imagen_antes_srcset": ""}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Item no encontrado")
     
+    catalog_cache.bump("gallery")
+    queue_image_variants("gallery", gallery_id, "imagen_antes", image_url)
     return {"imagen_url": image_url}
 
 @api_router.post("/gallery/{gallery_id}/upload-after")
 async def upload_after_image(gallery_id: str, file: UploadFile = File(...), user = Depends(get_admin_user)):
-    contents = await file.read()
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    image_url = f"data:{file.content_type};base64,{base64_image}"
+    image_url = await store_upload(file, IMAGE_UPLOAD_LIMIT)
     
     result = await db.gallery.update_one(
         {"id": gallery_id},
-        {"$set": {"imagen_despues": image_url}}
+        {"$set": {"imagen_despues": image_url}, "$unset": {"imagen_despues_srcset": ""}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Item no encontrado")
     
+    catalog_cache.bump("gallery")
+    queue_image_variants("gallery", gallery_id, "imagen_despues", image_url)
     return {"imagen_url": image_url}
 
 @api_router.delete("/gallery/{gallery_id}")
@@ -724,28 +2598,28 @@ async def delete_gallery_item(gallery_id: str, user = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    catalog_cache.bump("gallery")
     return {"message": "Item eliminado"}
 
-@api_router.get("/packages")
-async def get_packages():
+async def load_packages():
     packages = await db.packages.find({"activo": True}, {"_id": 0}).to_list(100)
     
+    service_ids = list({service_id for package in packages for service_id in package["service_ids"]})
+    services = dict(zip(service_ids, await DataLoaders().services.load_many(service_ids)))
     for package in packages:
-        services = []
-        for service_id in package["service_ids"]:
-            service = await db.services.find_one({"id": service_id}, {"_id": 0})
-            if service:
-                services.append(service)
-        package["services"] = services
+        package["services"] = [services[service_id] for service_id in package["service_ids"] if services[service_id]]
     
     return packages
 
+@api_router.get("/packages")
+async def get_packages(request: Request):
+    return await catalog_cache.respond("packages", request, load_packages)
+
 @api_router.post("/packages")
-async def create_package(package: PackageCreate, user = Depends(get_admin_user)):
+async def create_package(package: PackageCreate, user = Depends(get_admin_user), loaders: DataLoaders = Depends(get_loaders)):
     precio_original = 0
     
-    for service_id in package.service_ids:
-        service = await db.services.find_one({"id": service_id}, {"_id": 0})
+    for service in await loaders.services.load_many(package.service_ids):
         if service:
             precio_original += service["precio"]
     
@@ -767,6 +2641,7 @@ async def create_package(package: PackageCreate, user = Depends(get_admin_user))
     }
     
     await db.packages.insert_one(package_dict.copy())
+    catalog_cache.bump("packages")
     
     return {
         "id": package_dict["id"],
@@ -787,65 +2662,599 @@ async def delete_package(package_id: str, user = Depends(get_admin_user)):
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Paquete no encontrado")
+    catalog_cache.bump("packages")
     return {"message": "Paquete eliminado"}
 
-@api_router.get("/stats")
-async def get_stats(user = Depends(get_admin_user)):
-    total_appointments = await db.appointments.count_documents({})
-    pending_appointments = await db.appointments.count_documents({"estado": "pendiente"})
-    confirmed_appointments = await db.appointments.count_documents({"estado": "confirmada"})
-    total_services = await db.services.count_documents({"activo": True})
+@api_router.get("/notifications/metrics")
+async def get_notification_metrics(user = Depends(get_admin_user)):
+    return await notification_outbox.stats()
+
+@api_router.get("/auth/token-cache/metrics")
+async def get_token_cache_metrics(user = Depends(get_admin_user)):
+    """Aciertos y fallos de la caché de tokens verificados del proceso que responde"""
+    return token_cache.stats()
+
+class SingleFlightMemo:
+    """Memoiza por pocos segundos el resultado de una carga.
+
+    Mientras una carga está en curso, las demás peticiones esperan esa misma
+    tarea en vez de lanzar otra: varias pestañas del panel comparten una
+    consulta a Mongo.
+
+    Con serve_stale, al vencer el TTL se sigue sirviendo el valor anterior
+    mientras se recarga en segundo plano: solo la primera carga hace esperar.
+    """
+
+    def __init__(self, ttl: float, serve_stale: bool = False):
+        self.ttl = ttl
+        self.serve_stale = serve_stale
+        self.value = None
+        self.expires_at = 0.0
+        self.inflight: Optional[asyncio.Task] = None
+        self.generation = 0
+
+    def invalidate(self):
+        self.generation += 1
+        self.expires_at = 0.0
+
+    async def get(self, loader):
+        if time.monotonic() < self.expires_at:
+            return self.value
+        if self.inflight is None:
+            self.inflight = asyncio.create_task(self.load(loader))
+            if self.serve_stale:
+                self.inflight.add_done_callback(self.log_failure)
+        if self.serve_stale and self.value is not None:
+            return self.value
+        # shield: si una petición se cancela, la carga sigue para las demás
+        return await asyncio.shield(self.inflight)
+
+    @staticmethod
+    def log_failure(task: asyncio.Task):
+        # Una recarga en segundo plano puede fallar sin nadie esperándola
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Error recargando datos memoizados: {str(task.exception())}")
+
+    async def load(self, loader):
+        generation = self.generation
+        try:
+            value = await loader()
+            # Si hubo una escritura durante la carga, el resultado sirve pero no se guarda
+            if generation == self.generation:
+                self.value = value
+                self.expires_at = time.monotonic() + self.ttl
+            return value
+        finally:
+            self.inflight = None
+
+stats_memo = SingleFlightMemo(STATS_CACHE_TTL)
+
+async def load_stats() -> dict:
+    # Un solo $group por estado; el $sort previo deja que Mongo lo resuelva
+    # recorriendo el índice (estado, fecha, id) sin leer los documentos
+    by_estado, total_services = await asyncio.gather(
+        db.appointments.aggregate([
+            {"$sort": {"estado": 1}},
+            {"$project": {"_id": 0, "estado": 1}},
+            {"$group": {"_id": "$estado", "count": {"$sum": 1}}}
+        ]).to_list(None),
+        db.services.count_documents({"activo": True})
+    )
+    counts = {row["_id"]: row["count"] for row in by_estado}
     
     return {
-        "total_citas": total_appointments,
-        "citas_pendientes": pending_appointments,
-        "citas_confirmadas": confirmed_appointments,
+        "total_citas": sum(counts.values()),
+        "citas_pendientes": counts.get("pendiente", 0),
+        "citas_confirmadas": counts.get("confirmada", 0),
         "servicios_activos": total_services
     }
 
+@api_router.get("/stats")
+async def get_stats(user = Depends(get_admin_user)):
+    return await stats_memo.get(load_stats)
+
 @api_router.get("/stats/advanced")
-async def get_advanced_stats(user = Depends(get_admin_user)):
-    appointments = await db.appointments.find({"estado": "confirmada"}, {"_id": 0}).to_list(10000)
-    services = await db.services.find({"activo": True}, {"_id": 0}).to_list(100)
-    
-    ingresos_por_mes = {}
-    servicios_populares = {}
-    ocupacion_semanal = {str(i): 0 for i in range(7)}
-    
-    for apt in appointments:
-        service = await db.services.find_one({"id": apt["service_id"]}, {"_id": 0})
-        if service:
-            apt_date = datetime.fromisoformat(apt["fecha"])
-            mes_key = apt_date.strftime("%Y-%m")
-            
-            ingresos_por_mes[mes_key] = ingresos_por_mes.get(mes_key, 0) + service["precio"]
-            
-            servicios_populares[service["nombre"]] = servicios_populares.get(service["nombre"], 0) + 1
-            
-            dia_semana = str(apt_date.weekday())
-            ocupacion_semanal[dia_semana] = ocupacion_semanal.get(dia_semana, 0) + 1
-    
-    ingresos_chart = [{"mes": k, "ingresos": v} for k, v in sorted(ingresos_por_mes.items())]
-    
-    servicios_chart = [{"servicio": k, "cantidad": v} for k, v in sorted(servicios_populares.items(), key=lambda x: x[1], reverse=True)][:5]
-    
+async def get_advanced_stats(desde: Optional[str] = None, hasta: Optional[str] = None, user = Depends(get_admin_user)):
+    """Gráficos del dashboard a partir de stats_daily: un documento por día y servicio"""
+    match = {}
+    dia_filter = fecha_range_filter(desde, hasta)
+    if dia_filter:
+        match["dia"] = dia_filter
+    
+    result = await db.stats_daily.aggregate([
+        {"$match": match},
+        {"$facet": {
+            "ingresos": [
+                {"$group": {"_id": "$mes", "ingresos": {"$sum": "$ingresos"}, "citas": {"$sum": "$confirmadas"}}},
+                {"$match": {"citas": {"$gt": 0}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "servicios": [
+                {"$group": {"_id": "$service_id", "cantidad": {"$sum": "$confirmadas"}}},
+                {"$lookup": {
+                    "from": "services",
+                    "localField": "_id",
+                    "foreignField": "id",
+                    "pipeline": [{"$project": {"_id": 0, "nombre": 1}}],
+                    "as": "service"
+                }},
+                {"$unwind": "$service"},
+                {"$group": {"_id": "$service.nombre", "cantidad": {"$sum": "$cantidad"}}},
+                {"$match": {"cantidad": {"$gt": 0}}},
+                {"$sort": {"cantidad": -1, "_id": 1}},
+                {"$limit": 5}
+            ],
+            "ocupacion": [
+                {"$group": {"_id": "$dia_semana", "citas": {"$sum": "$confirmadas"}}}
+            ],
+            "horas": [
+                {"$project": {"horas": {"$objectToArray": {"$ifNull": ["$horas", {}]}}}},
+                {"$unwind": "$horas"},
+                {"$group": {"_id": "$horas.k", "citas": {"$sum": "$horas.v"}}},
+                {"$match": {"citas": {"$gt": 0}}},
+                {"$sort": {"_id": 1}}
+            ]
+        }}
+    ]).to_list(1)
+    facets = result[0] if result else {"ingresos": [], "servicios": [], "ocupacion": [], "horas": []}
+    
+    # dia_semana va de 1 (lunes) a 7 (domingo), como $isoDayOfWeek
+    por_dia = {row["_id"]: row["citas"] for row in facets["ocupacion"]}
     dias = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
-    ocupacion_chart = [{"dia": dias[int(k)], "citas": v} for k, v in sorted(ocupacion_semanal.items())]
     
     return {
-        "ingresos_mensuales": ingresos_chart,
-        "servicios_populares": servicios_chart,
-        "ocupacion_semanal": ocupacion_chart
+        "ingresos_mensuales": [{"mes": row["_id"], "ingresos": row["ingresos"]} for row in facets["ingresos"]],
+        "servicios_populares": [{"servicio": row["_id"], "cantidad": row["cantidad"]} for row in facets["servicios"]],
+        "ocupacion_semanal": [{"dia": dia, "citas": por_dia.get(i + 1, 0)} for i, dia in enumerate(dias)],
+        "ocupacion_por_hora": [{"hora": f"{row['_id']}:00", "citas": row["citas"]} for row in facets["horas"]]
     }
 
+async def backfill_review_names():
+    """Guarda user_nombre en las reseñas creadas antes de que se guardara al escribirlas"""
+    await db.reviews.aggregate([
+        {"$match": {"user_nombre": {"$exists": False}}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "nombre": 1}}],
+            "as": "author"
+        }},
+        {"$project": {"user_nombre": {"$ifNull": [{"$arrayElemAt": ["$author.nombre", 0]}, "Usuario"]}}},
+        {"$merge": {"into": "reviews", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]).to_list(None)
+    logging.info("Nombres de autor agregados a las reseñas")
+
+# Colección temporal donde rebuild_stats_rollups recalcula stats_daily
+STATS_REBUILD_COLLECTION = "stats_daily_rebuild"
+
+def stats_rollup_pipeline() -> List[dict]:
+    """Recalcula desde las citas confirmadas los documentos de stats_daily"""
+    return [
+        {"$match": {"estado": "confirmada"}},
+        {"$group": {
+            "_id": {
+                "dia": {"$substrBytes": ["$fecha", 0, 10]},
+                "service_id": "$service_id",
+                "hora": {"$substrBytes": ["$fecha", 11, 2]}
+            },
+            "citas": {"$sum": 1},
+            "ingresos": {"$sum": {"$ifNull": ["$precio", 0]}}
+        }},
+        {"$group": {
+            "_id": {"dia": "$_id.dia", "service_id": "$_id.service_id"},
+            "confirmadas": {"$sum": "$citas"},
+            "ingresos": {"$sum": "$ingresos"},
+            "horas": {"$push": {"k": "$_id.hora", "v": "$citas"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "dia": "$_id.dia",
+            "service_id": "$_id.service_id",
+            "mes": {"$substrBytes": ["$_id.dia", 0, 7]},
+            "dia_semana": {"$isoDayOfWeek": {"$dateFromString": {"dateString": "$_id.dia", "format": "%Y-%m-%d"}}},
+            "confirmadas": 1,
+            "ingresos": 1,
+            "horas": {"$arrayToObject": "$horas"}
+        }}
+    ]
+
+def normalize_rollup(doc: dict) -> tuple:
+    """Forma comparable de un rollup: los contadores que volvieron a cero no cuentan"""
+    horas = tuple(sorted((hora, count) for hora, count in (doc.get("horas") or {}).items() if count))
+    return (doc.get("confirmadas", 0), round(doc.get("ingresos", 0), 2), horas)
+
+async def verify_stats_rollups() -> bool:
+    """Compara stats_daily con un recálculo completo desde las citas"""
+    expected = {}
+    async for doc in db.appointments.aggregate(stats_rollup_pipeline()):
+        expected[(doc["dia"], doc["service_id"])] = normalize_rollup(doc)
+    
+    actual = {}
+    async for doc in db.stats_daily.find({}, {"_id": 0}):
+        rollup = normalize_rollup(doc)
+        if rollup != (0, 0, ()):
+            actual[(doc["dia"], doc["service_id"])] = rollup
+    
+    mismatches = [key for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key)]
+    for dia, service_id in sorted(mismatches)[:20]:
+        logging.error(f"stats_daily difiere en {dia} / {service_id}: "
+                      f"esperado {expected.get((dia, service_id))}, guardado {actual.get((dia, service_id))}")
+    logging.info(f"stats_daily verificado: {len(expected)} rollups, {len(mismatches)} diferencias")
+    return not mismatches
+
+async def rebuild_stats_rollups() -> bool:
+    """Regenera stats_daily desde el historial y lo verifica contra un recálculo completo.
+
+    Las citas confirmadas antes de que existiera el precio congelado toman el
+    precio actual de su servicio.
+    
+    Los $inc que lleguen entre el recálculo y la fusión de su documento se
+    pierden: conviene correrlo con la API detenida o repetir verify-stats
+    después, que reporta cualquier diferencia que haya quedado.
+    """
+    await db.appointments.aggregate([
+        {"$match": {"estado": "confirmada", "precio": {"$exists": False}}},
+        {"$lookup": {
+            "from": "services",
+            "localField": "service_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 0, "precio": 1}}],
+            "as": "service"
+        }},
+        {"$project": {"precio": {"$ifNull": [{"$arrayElemAt": ["$service.precio", 0]}, 0]}}},
+        {"$merge": {"into": "appointments", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]).to_list(None)
+    
+    # Se recalcula en una colección aparte y se funde documento a documento:
+    # un $out directo reemplazaría stats_daily entero y perdería los $inc de
+    # las citas confirmadas mientras corre el recálculo
+    await db.appointments.aggregate(stats_rollup_pipeline() + [{"$out": STATS_REBUILD_COLLECTION}]).to_list(None)
+    try:
+        rebuilt = db[STATS_REBUILD_COLLECTION]
+        await rebuilt.aggregate([
+            {"$project": {"_id": 0}},
+            {"$merge": {
+                "into": "stats_daily",
+                "on": ["dia", "service_id"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }}
+        ]).to_list(None)
+        
+        # Rollups sin citas confirmadas detrás (por ejemplo de citas borradas)
+        orphans = await db.stats_daily.aggregate([
+            {"$lookup": {
+                "from": STATS_REBUILD_COLLECTION,
+                "let": {"dia": "$dia", "service_id": "$service_id"},
+                "pipeline": [
+                    {"$match": {"$expr": {"$and": [
+                        {"$eq": ["$dia", "$$dia"]},
+                        {"$eq": ["$service_id", "$$service_id"]}
+                    ]}}},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "rebuilt"
+            }},
+            {"$match": {"rebuilt": []}},
+            {"$project": {"_id": 1}}
+        ]).to_list(None)
+        if orphans:
+            await db.stats_daily.delete_many({"_id": {"$in": [doc["_id"] for doc in orphans]}})
+    finally:
+        await db.drop_collection(STATS_REBUILD_COLLECTION)
+    logging.info("stats_daily regenerado desde las citas confirmadas")
+    return await verify_stats_rollups()
+
+async def rebuild_service_ratings():
+    """Recalcula rating_sum, total_reviews, rating_counts y rating_promedio de todos los servicios desde db.reviews"""
+    await db.services.aggregate([
+        {"$lookup": {
+            "from": "reviews",
+            "localField": "id",
+            "foreignField": "service_id",
+            "pipeline": [{"$group": {"_id": "$rating", "count": {"$sum": 1}}}],
+            "as": "agg"
+        }},
+        {"$project": {
+            "rating_sum": {"$sum": {"$map": {"input": "$agg", "in": {"$multiply": ["$$this._id", "$$this.count"]}}}},
+            "total_reviews": {"$sum": "$agg.count"},
+            "rating_counts": {"$arrayToObject": {"$map": {
+                "input": "$agg",
+                "in": {"k": {"$toString": "$$this._id"}, "v": "$$this.count"}
+            }}}
+        }},
+        {"$set": {
+            "rating_promedio": {"$cond": [
+                {"$gt": ["$total_reviews", 0]},
+                {"$round": [{"$divide": ["$rating_sum", "$total_reviews"]}, 1]},
+                0
+            ]}
+        }},
+        {"$merge": {"into": "services", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]).to_list(None)
+    catalog_cache.bump("services", "packages", "gallery")
+    logging.info("Agregados de reseñas de servicios recalculados")
+
+def business_utc_offset() -> int:
+    """Desfase en segundos de la hora del negocio respecto de UTC"""
+    offset = (business_now() - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+    return int(round(offset / 60) * 60)
+
+async def load_appointment_columns() -> analytics.AppointmentColumns:
+    """Recorre todas las citas por lotes y las carga en columnas de NumPy"""
+    started = time.perf_counter()
+    services = await db.services.find({}, {"_id": 0, "id": 1, "precio": 1}).to_list(None)
+    builder = analytics.ColumnBuilder({s["id"]: s.get("precio", 0) for s in services}, business_utc_offset())
+    
+    cursor = db.appointments.find(
+        {},
+        {"_id": 0, "fecha": 1, "created_at": 1, "service_id": 1, "precio": 1, "estado": 1}
+    ).batch_size(ANALYTICS_BATCH_SIZE)
+    batch = []
+    async for apt in cursor:
+        batch.append(apt)
+        if len(batch) >= ANALYTICS_BATCH_SIZE:
+            builder.add_batch(batch)
+            batch = []
+    builder.add_batch(batch)
+    
+    columns = builder.build()
+    logging.info(f"Columnas de analítica cargadas: {len(columns)} citas en {(time.perf_counter() - started) * 1000:.0f}ms")
+    return columns
+
+# La carga en frío recorre todas las citas (segundos con 1M): al vencer el TTL
+# se recarga en segundo plano y las peticiones siguen usando las columnas anteriores
+analytics_memo = SingleFlightMemo(ANALYTICS_CACHE_TTL, serve_stale=True)
+
+async def analytics_window(desde: Optional[str], hasta: Optional[str]):
+    """Columnas de citas (memoizadas) y la máscara del rango de fechas pedido"""
+    columns = await analytics_memo.get(load_appointment_columns)
+    mask = columns.window(
+        parse_date_param(desde, "desde") if desde else None,
+        parse_date_param(hasta, "hasta") if hasta else None
+    )
+    return columns, mask
+
+async def service_names() -> dict:
+    services = await db.services.find({}, {"_id": 0, "id": 1, "nombre": 1}).to_list(None)
+    return {s["id"]: s["nombre"] for s in services}
+
+def with_service_names(rows: List[dict], names: dict) -> List[dict]:
+    return [{**row, "servicio": names.get(row["service_id"], row["service_id"])} for row in rows]
+
+@api_router.get("/analytics/heatmap")
+async def get_occupancy_heatmap(desde: Optional[str] = None, hasta: Optional[str] = None, user = Depends(get_admin_user)):
+    """Citas no canceladas por día de la semana (filas, lunes primero) y hora (columnas)"""
+    columns, mask = await analytics_window(desde, hasta)
+    return {
+        "dias": ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"],
+        "horas": [f"{hour:02d}:00" for hour in range(24)],
+        "citas": analytics.occupancy_heatmap(columns, mask).tolist()
+    }
+
+@api_router.get("/analytics/revenue")
+async def get_revenue_by_service(desde: Optional[str] = None, hasta: Optional[str] = None, user = Depends(get_admin_user)):
+    """Ingresos de citas confirmadas por mes y servicio"""
+    columns, mask = await analytics_window(desde, hasta)
+    return with_service_names(analytics.revenue_by_service_month(columns, mask), await service_names())
+
+@api_router.get("/analytics/lead-time")
+async def get_lead_time(desde: Optional[str] = None, hasta: Optional[str] = None, user = Depends(get_admin_user)):
+    """Horas de anticipación entre la reserva (created_at) y la cita"""
+    columns, mask = await analytics_window(desde, hasta)
+    result = analytics.lead_time(columns, mask)
+    result["por_servicio"] = with_service_names(result["por_servicio"], await service_names())
+    return result
+
+@api_router.get("/analytics/cancellations")
+async def get_cancellation_rates(desde: Optional[str] = None, hasta: Optional[str] = None, user = Depends(get_admin_user)):
+    columns, mask = await analytics_window(desde, hasta)
+    result = analytics.cancellation_rates(columns, mask)
+    result["por_servicio"] = with_service_names(result["por_servicio"], await service_names())
+    return result
+
+@api_router.get("/analytics/promotions")
+async def get_promotion_uplift(user = Depends(get_admin_user)):
+    """Reservas por día durante cada promoción frente al mismo número de días previos"""
+    columns = await analytics_memo.get(load_appointment_columns)
+    promotions = await db.promotions.find(
+        {}, {"_id": 0, "id": 1, "codigo": 1, "fecha_inicio": 1, "fecha_fin": 1}
+    ).sort("fecha_inicio", 1).to_list(None)
+    uplift = analytics.promotion_uplift(
+        columns,
+        analytics.parse_local_epoch([promo["fecha_inicio"] for promo in promotions]),
+        analytics.parse_local_epoch([promo["fecha_fin"] for promo in promotions])
+    )
+    return [{**promo, **stats} for promo, stats in zip(promotions, uplift)]
+
+APPOINTMENT_EXPORT_COLUMNS = [
+    "id", "fecha", "estado", "servicio", "precio", "duracion",
+    "cliente", "email", "telefono", "comprobante_pago", "created_at"
+]
+CLIENT_EXPORT_COLUMNS = ["id", "nombre", "email", "telefono", "created_at"]
+REVENUE_EXPORT_COLUMNS = ["dia", "service_id", "servicio", "confirmadas", "ingresos"]
+
+def encode_export_rows(rows: List[dict], columns: List[str], formato: str) -> bytes:
+    if formato == "ndjson":
+        return "".join(
+            json.dumps({column: row.get(column) for column in columns}, ensure_ascii=False, default=str) + "\n"
+            for row in rows
+        ).encode("utf-8")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["" if row.get(column) is None else row.get(column) for column in columns])
+    return buffer.getvalue().encode("utf-8")
+
+async def stream_export(cursor, enrich, columns: List[str], formato: str):
+    """Genera el archivo lote a lote directamente desde el cursor.
+
+    StreamingResponse solo pide el siguiente trozo cuando el anterior se
+    envió, y el cursor solo trae el siguiente lote cuando se le pide: si el
+    cliente lee despacio, la lectura de Mongo espera. En memoria hay a lo
+    sumo un lote.
+    """
+    try:
+        if formato == "csv":
+            yield encode_export_rows([{column: column for column in columns}], columns, formato)
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield encode_export_rows(await enrich(batch), columns, formato)
+                batch = []
+        if batch:
+            yield encode_export_rows(await enrich(batch), columns, formato)
+    finally:
+        await cursor.close()
+
+def export_response(name: str, rows, formato: str, desde: Optional[str] = None, hasta: Optional[str] = None) -> StreamingResponse:
+    filename = "_".join(part for part in [name, desde, hasta] if part) + (".csv" if formato == "csv" else ".ndjson")
+    return StreamingResponse(
+        rows,
+        media_type="text/csv; charset=utf-8" if formato == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def appointment_export_rows(batch: List[dict]) -> List[dict]:
+    # Loaders nuevos por lote: un $in de usuarios y otro de servicios, sin acumular entre lotes
+    loaders = DataLoaders()
+    users = await loaders.users.load_many([apt["user_id"] for apt in batch])
+    services = await loaders.services.load_many([apt["service_id"] for apt in batch])
+    rows = []
+    for apt, user_data, service in zip(batch, users, services):
+        user_data = user_data or {}
+        service = service or {}
+        rows.append({
+            "id": apt["id"],
+            "fecha": apt["fecha"],
+            "estado": apt["estado"],
+            "servicio": service.get("nombre"),
+            "precio": apt.get("precio", service.get("precio")),
+            "duracion": apt.get("duracion") or service.get("duracion"),
+            "cliente": user_data.get("nombre"),
+            "email": user_data.get("email"),
+            "telefono": user_data.get("telefono"),
+            "comprobante_pago": apt.get("comprobante_pago"),
+            "created_at": apt.get("created_at")
+        })
+    return rows
+
+async def revenue_export_rows(batch: List[dict]) -> List[dict]:
+    services = await DataLoaders().services.load_many([row["service_id"] for row in batch])
+    return [{**row, "servicio": (service or {}).get("nombre")} for row, service in zip(batch, services)]
+
+async def identity_rows(batch: List[dict]) -> List[dict]:
+    return batch
+
+@api_router.get("/export/appointments")
+async def export_appointments(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    estado: Optional[str] = None,
+    formato: str = Query("csv", pattern="^(csv|ndjson)$"),
+    user = Depends(get_admin_user)
+):
+    """Todas las citas del rango con los datos del cliente y del servicio, ordenadas por fecha"""
+    query = {}
+    fecha_filter = fecha_range_filter(desde, hasta)
+    if fecha_filter:
+        query["fecha"] = fecha_filter
+    if estado:
+        query["estado"] = estado
+    cursor = db.appointments.find(
+        query,
+        {"_id": 0, "id": 1, "user_id": 1, "service_id": 1, "fecha": 1, "estado": 1,
+         "precio": 1, "duracion": 1, "comprobante_pago": 1, "created_at": 1}
+    ).sort([("fecha", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    rows = stream_export(cursor, appointment_export_rows, APPOINTMENT_EXPORT_COLUMNS, formato)
+    return export_response("citas", rows, formato, desde, hasta)
+
+@api_router.get("/export/clients")
+async def export_clients(formato: str = Query("csv", pattern="^(csv|ndjson)$"), user = Depends(get_admin_user)):
+    cursor = db.users.find(
+        {"role": "cliente"},
+        {"_id": 0, "id": 1, "nombre": 1, "email": 1, "telefono": 1, "created_at": 1}
+    ).batch_size(EXPORT_BATCH_SIZE)
+    return export_response("clientes", stream_export(cursor, identity_rows, CLIENT_EXPORT_COLUMNS, formato), formato)
+
+@api_router.get("/export/revenue")
+async def export_revenue(
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    formato: str = Query("csv", pattern="^(csv|ndjson)$"),
+    user = Depends(get_admin_user)
+):
+    """Ingresos y citas confirmadas por día y servicio, desde stats_daily"""
+    query = {"confirmadas": {"$gt": 0}}
+    dia_filter = fecha_range_filter(desde, hasta)
+    if dia_filter:
+        query["dia"] = dia_filter
+    cursor = db.stats_daily.find(
+        query, {"_id": 0, "dia": 1, "service_id": 1, "confirmadas": 1, "ingresos": 1}
+    ).sort([("dia", 1), ("service_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    rows = stream_export(cursor, revenue_export_rows, REVENUE_EXPORT_COLUMNS, formato)
+    return export_response("ingresos", rows, formato, desde, hasta)
+
+async def ensure_unique_review_per_appointment():
+    """Una reseña por cita: el índice único decide entre envíos simultáneos (ver create_review)"""
+    existing = (await db.reviews.index_information()).get("appointment_id_1")
+    if existing and not existing.get("unique"):
+        # Reemplaza el índice no único de versiones anteriores
+        await db.reviews.drop_index("appointment_id_1")
+    try:
+        await db.reviews.create_index("appointment_id", unique=True)
+    except OperationFailure as e:
+        await db.reviews.create_index("appointment_id")
+        logging.error(
+            f"No se pudo crear el índice único de reviews.appointment_id (¿reseñas duplicadas?): {str(e)}. "
+            "Elimine los duplicados y ejecute manage.py rebuild-ratings"
+        )
+
+async def ensure_indexes():
+    """Crea los índices que usan las consultas del API"""
+    await db.services.create_index("id")
+    await db.reviews.create_index("service_id")
+    await ensure_unique_review_per_appointment()
+    # Páginas de reseñas por servicio, más recientes primero o por rating
+    await db.reviews.create_index([("service_id", 1), ("created_at", -1), ("id", -1)])
+    await db.reviews.create_index([("service_id", 1), ("rating", -1), ("created_at", -1), ("id", -1)])
+    # Paginación de citas por (fecha, id) con los filtros del listado
+    await db.appointments.create_index([("fecha", 1), ("id", 1)])
+    await db.appointments.create_index([("user_id", 1), ("fecha", 1), ("id", 1)])
+    await db.appointments.create_index([("service_id", 1), ("fecha", 1), ("id", 1)])
+    # También sirve al $group por estado de /api/stats (prefijo estado)
+    await db.appointments.create_index([("estado", 1), ("fecha", 1), ("id", 1)])
+    await db.slot_claims.create_index([("service_id", 1), ("slot", 1)], unique=True)
+    await db.slot_claims.create_index("appointment_id")
+    # Borra los bloques que nunca se confirmaron (el campo solo existe mientras están pendientes)
+    await db.slot_claims.create_index("pending_until", expireAfterSeconds=0)
+    await db.appointments.create_index([("reminder_sent", 1), ("fecha", 1)])
+    await db.outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.outbox.create_index("id")
+    await db.outbox.create_index("key", unique=True, partialFilterExpression={"key": {"$exists": True}})
+    await db.stats_daily.create_index([("dia", 1), ("service_id", 1)], unique=True)
+
 app.include_router(api_router)
 
+app.add_middleware(UploadLimitMiddleware)
+
+if QUERY_COUNT_HEADER:
+    @app.middleware("http")
+    async def query_count_header(request: Request, call_next):
+        with count_queries() as counter:
+            response = await call_next(request)
+        response.headers["X-Query-Count"] = str(counter.total)
+        return response
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 logging.basicConfig(
@@ -856,11 +3265,21 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
 async def startup_event():
-    scheduler.add_job(send_appointment_reminders, 'interval', hours=1)
-    scheduler.start()
-    logger.info("Scheduler iniciado - Recordatorios de citas cada hora")
+    await ensure_indexes()
+    start_password_executor()
+    await calibrate_bcrypt_rounds()
+    await notification_outbox.start()
+    scheduler.add_job(reminder_timers.refill, 'interval', minutes=REMINDER_REFILL_MINUTES)
+    # El scheduler arranca en pausa: lo reanuda este proceso solo si gana el lease
+    scheduler.start(paused=True)
+    await scheduler_lease.start()
+    logger.info(f"Scheduler iniciado - Recordatorios por cita, recarga cada {REMINDER_REFILL_MINUTES} minutos")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await scheduler_lease.stop()
     scheduler.shutdown()
+    await notification_outbox.stop()
+    stop_password_executor()
+    stop_image_executor()
     client_db.close()
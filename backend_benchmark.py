@@ -0,0 +1,357 @@
+import requests
+import os
+import sys
+import time
+import random
+import resource
+import asyncio
+import multiprocessing
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+class SyntheticAppointmentCursor:
+    """Cursor asíncrono con citas generadas al vuelo, como el de Motor pero sin Mongo"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.start = datetime(2024, 1, 1, 10)
+
+    async def __aiter__(self):
+        for i in range(self.rows):
+            yield {
+                'id': f"apt-{i:08d}",
+                'fecha': (self.start + timedelta(minutes=30 * i)).isoformat(),
+                'estado': 'confirmada',
+                'servicio': 'Manicure semipermanente',
+                'precio': 50000,
+                'duracion': 60,
+                'cliente': f"Cliente {i}",
+                'email': f"cliente{i}@example.com",
+                'telefono': f"+57300{i:07d}",
+                'comprobante_pago': f"/api/appointments/apt-{i:08d}/proof",
+                'created_at': self.start.isoformat()
+            }
+
+    async def close(self):
+        pass
+
+def export_peak_rss(rows):
+    """Proceso hijo: exporta rows citas con stream_export; devuelve (MB de RSS máximo añadidos, MB generados)"""
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'beautytouch_bench')
+    sys.path.insert(0, str(Path(__file__).resolve().parent / 'backend'))
+    import server
+
+    async def drain():
+        size = 0
+        chunks = server.stream_export(SyntheticAppointmentCursor(rows), server.identity_rows, server.APPOINTMENT_EXPORT_COLUMNS, 'csv')
+        async for chunk in chunks:
+            size += len(chunk)
+        return size
+
+    # ru_maxrss es el máximo histórico del proceso (KB en Linux): se mide cuánto sube durante la exportación
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = asyncio.run(drain())
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (after - before) / 1024, size / 1024 / 1024
+
+class BeautyTouchBenchmark:
+    """Benchmarks de carga contra una instancia del backend.
+
+    Ejecutar contra el backend antes y después de un cambio para comparar
+    los resultados, p. ej.: python backend_benchmark.py http://localhost:8001
+    """
+
+    def __init__(self, base_url="https://beauty-touch-app.preview.emergentagent.com"):
+        self.base_url = base_url
+        self.api_url = f"{base_url}/api"
+        self.admin_token = None
+        self.service_id = None
+        self.failures = []
+
+    def percentile(self, values, pct):
+        """Percentil por rango más cercano"""
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+        return ordered[index]
+
+    def print_latencies(self, name, latencies):
+        """Imprime p50/p99/máximo en milisegundos"""
+        print(f"  {name}: n={len(latencies)} "
+              f"p50={self.percentile(latencies, 50) * 1000:.1f}ms "
+              f"p99={self.percentile(latencies, 99) * 1000:.1f}ms "
+              f"max={max(latencies, default=0) * 1000:.1f}ms")
+
+    def timed_request(self, method, endpoint, **kwargs):
+        """Hace una petición y devuelve (status, segundos)"""
+        start = time.perf_counter()
+        try:
+            response = requests.request(method, f"{self.api_url}/{endpoint}", timeout=60, **kwargs)
+            status = response.status_code
+        except Exception:
+            status = None
+        return status, time.perf_counter() - start
+
+    def setup(self):
+        """Obtiene token de admin y un servicio para las pruebas"""
+        response = requests.post(f"{self.api_url}/auth/login", json={
+            'email': 'admin@beautytouchnails.com',
+            'password': 'admin123'
+        }, timeout=30)
+        if response.status_code == 200:
+            self.admin_token = response.json()['token']
+
+        services = requests.get(f"{self.api_url}/services", timeout=30).json()
+        if services:
+            self.service_id = services[0]['id']
+
+    def bench_login_burst(self, logins=200, concurrency=32, probes=200):
+        """Ráfaga de logins concurrentes mientras se mide /api/availability"""
+        print(f"\n🔐 Login burst: {logins} logins, concurrencia {concurrency}")
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+        credentials = {'email': 'admin@beautytouchnails.com', 'password': 'admin123'}
+
+        def do_login(_):
+            return self.timed_request('POST', 'auth/login', json=credentials)
+
+        def do_probe(_):
+            return self.timed_request('GET', 'availability', params={
+                'service_id': self.service_id or 'none',
+                'fecha': tomorrow
+            })
+
+        with ThreadPoolExecutor(max_workers=concurrency + 4) as pool:
+            login_futures = [pool.submit(do_login, i) for i in range(logins)]
+            probe_results = []
+            for i in range(probes):
+                probe_results.append(pool.submit(do_probe, i).result())
+            login_results = [f.result() for f in login_futures]
+
+        ok = [t for status, t in login_results if status == 200]
+        busy = sum(1 for status, _ in login_results if status == 503)
+        self.print_latencies("login", ok)
+        print(f"  login 503 (cola llena): {busy}")
+        self.print_latencies("availability concurrente", [t for status, t in probe_results if status == 200])
+
+    def bench_availability_range(self, days=30):
+        """N llamadas a /api/availability (una por día) contra una sola a /api/availability/range"""
+        print(f"\n📅 Disponibilidad de {days} días")
+        start = datetime.now() + timedelta(days=1)
+        dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+        
+        single_start = time.perf_counter()
+        for fecha in dates:
+            self.timed_request('GET', 'availability', params={'service_id': self.service_id, 'fecha': fecha})
+        single_total = time.perf_counter() - single_start
+        
+        status, range_total = self.timed_request('GET', 'availability/range', params={
+            'service_id': self.service_id,
+            'desde': dates[0],
+            'hasta': dates[-1]
+        })
+        print(f"  {days} llamadas de un día: {single_total * 1000:.1f}ms")
+        print(f"  1 llamada de rango (status {status}): {range_total * 1000:.1f}ms")
+
+    def bench_scheduling_engine(self, appointments=100000, queries=10000):
+        """Motor de intervalos (sin servidor): chequeos de solapamiento con 100k citas vs búsqueda lineal"""
+        sys.path.insert(0, str(Path(__file__).resolve().parent / 'backend'))
+        from scheduling import BusyIntervals
+
+        print(f"\n🗓️  Motor de agenda: {appointments} citas, {queries} consultas")
+        rng = random.Random(42)
+        # Línea de tiempo continua en minutos para forzar el peor caso (un solo recurso)
+        horizon = appointments * 120
+        intervals = []
+        for _ in range(appointments):
+            start = rng.randrange(0, horizon)
+            intervals.append((start, start + rng.choice([30, 60, 90])))
+
+        busy = BusyIntervals()
+        build_start = time.perf_counter()
+        for start, end in intervals:
+            busy.add(start, end)
+        build_total = time.perf_counter() - build_start
+
+        probes = [rng.randrange(0, horizon) for _ in range(queries)]
+        engine_start = time.perf_counter()
+        for start in probes:
+            busy.overlaps(start, start + 60)
+        engine_total = time.perf_counter() - engine_start
+
+        linear_probes = probes[:100]
+        linear_start = time.perf_counter()
+        for start in linear_probes:
+            any(s < start + 60 and start < e for s, e in intervals)
+        linear_total = (time.perf_counter() - linear_start) * queries / len(linear_probes)
+
+        print(f"  construcción: {build_total * 1000:.1f}ms ({len(busy)} bloques)")
+        print(f"  motor: {engine_total / queries * 1e6:.2f}µs por consulta")
+        print(f"  lineal (estimado): {linear_total / queries * 1e6:.2f}µs por consulta")
+
+    def bench_analytics_engine(self, appointments=1000000, batch=10000):
+        """Motor de analítica (sin servidor): carga por lotes y métricas vectorizadas sobre 1M citas.
+
+        Las métricas corren sobre columnas ya en memoria. La carga en columnas
+        es parte del arranque en frío de los endpoints (ver
+        bench_analytics_endpoints), que además incluye leer las citas de Mongo.
+        """
+        sys.path.insert(0, str(Path(__file__).resolve().parent / 'backend'))
+        import analytics
+
+        print(f"\n📊 Motor de analítica: {appointments} citas")
+        rng = random.Random(42)
+        prices = {f"srv-{i}": rng.choice([35000, 50000, 80000, 120000]) for i in range(20)}
+        service_ids = list(prices)
+        start = datetime(2021, 1, 1, 10)
+        builder = analytics.ColumnBuilder(prices, utc_offset=-5 * 3600)
+
+        load_total = 0.0
+        for offset in range(0, appointments, batch):
+            docs = []
+            for _ in range(min(batch, appointments - offset)):
+                fecha = start + timedelta(days=rng.randrange(0, 4 * 365), hours=rng.randrange(0, 9))
+                docs.append({
+                    'fecha': fecha.isoformat(),
+                    'created_at': (fecha - timedelta(hours=rng.randrange(1, 720))).isoformat() + '+00:00',
+                    'service_id': rng.choice(service_ids),
+                    'estado': rng.choice(analytics.STATES)
+                })
+            # Solo se mide la carga en columnas, no la generación de los datos sintéticos
+            load_start = time.perf_counter()
+            builder.add_batch(docs)
+            load_total += time.perf_counter() - load_start
+        load_start = time.perf_counter()
+        columns = builder.build()
+        load_total += time.perf_counter() - load_start
+        print(f"  carga en columnas (parte del arranque en frío, sin contar Mongo): {load_total * 1000:.1f}ms")
+
+        mask = columns.window()
+        promo_starts = analytics.parse_local_epoch([(start + timedelta(days=30 * i)).isoformat() for i in range(40)])
+        metrics = {
+            'heatmap': lambda: analytics.occupancy_heatmap(columns, mask),
+            'ingresos por servicio/mes': lambda: analytics.revenue_by_service_month(columns, mask),
+            'anticipación': lambda: analytics.lead_time(columns, mask),
+            'cancelaciones': lambda: analytics.cancellation_rates(columns, mask),
+            'promociones (40)': lambda: analytics.promotion_uplift(columns, promo_starts, promo_starts + 14 * 86400),
+            'rango de un año + heatmap': lambda: analytics.occupancy_heatmap(columns, columns.window(start.date(), start.date() + timedelta(days=365)))
+        }
+        for name, compute in metrics.items():
+            compute_start = time.perf_counter()
+            compute()
+            elapsed = time.perf_counter() - compute_start
+            print(f"  {name} (columnas en memoria): {elapsed * 1000:.1f}ms {'✅' if elapsed < 1 else '❌'}")
+
+    def bench_analytics_endpoints(self, repeats=20):
+        """Endpoint de analítica de punta a punta, incluido el arranque en frío.
+
+        La primera petición tras arrancar el servidor lee todas las citas de
+        Mongo y arma las columnas; las siguientes usan las columnas en memoria,
+        que al vencer ANALYTICS_CACHE_TTL se recargan en segundo plano.
+        """
+        print("\n📈 Endpoint de analítica (/api/analytics/heatmap)")
+        if not self.admin_token:
+            print("  sin token de admin, se omite")
+            return
+        headers = {'Authorization': f'Bearer {self.admin_token}'}
+        status, cold = self.timed_request('GET', 'analytics/heatmap', headers=headers)
+        print(f"  primera petición (en frío si el servidor recién arrancó), status {status}: {cold * 1000:.0f}ms")
+        warm = [self.timed_request('GET', 'analytics/heatmap', headers=headers)[1] for _ in range(repeats)]
+        self.print_latencies("siguientes (columnas en memoria)", warm)
+
+    def bench_export_stream(self):
+        """Descarga en streaming de la exportación de citas: tiempo al primer byte y throughput"""
+        print("\n📤 Exportación de citas (NDJSON en streaming)")
+        if not self.admin_token:
+            print("  sin token de admin, se omite")
+            return
+        start = time.perf_counter()
+        response = requests.get(f"{self.api_url}/export/appointments", params={'formato': 'ndjson'},
+                                headers={'Authorization': f'Bearer {self.admin_token}'}, stream=True, timeout=600)
+        first_byte = None
+        rows = size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)
+            rows += chunk.count(b'\n')
+        total = time.perf_counter() - start
+        print(f"  status {response.status_code}: {rows} filas, {size / 1024 / 1024:.1f}MB en {total:.2f}s "
+              f"(primer byte {(first_byte or 0) * 1000:.0f}ms, {rows / total if total else 0:.0f} filas/s)")
+
+    def bench_export_memory(self, sizes=(50000, 500000), max_growth_mb=16):
+        """Memoria de stream_export (sin servidor): el RSS máximo no debe crecer con el número de filas"""
+        print(f"\n🧮 Memoria de la exportación: {' vs '.join(str(rows) for rows in sizes)} citas")
+        growth = []
+        for rows in sizes:
+            # Un proceso nuevo por tamaño: ru_maxrss no baja dentro de un mismo proceso
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                added, size = pool.submit(export_peak_rss, rows).result()
+            growth.append(added)
+            print(f"  {rows} filas ({size:.1f}MB de CSV): RSS máximo +{added:.1f}MB")
+        ok = growth[-1] - growth[0] < max_growth_mb
+        print(f"  diferencia: {growth[-1] - growth[0]:.1f}MB {'✅' if ok else '❌'}")
+        if not ok:
+            self.failures.append('export_memory')
+
+    def image_bytes(self, url, cache):
+        """Bytes extra que descarga una imagen (las data: URL ya vienen en el JSON)"""
+        if not url or url.startswith('data:'):
+            return 0
+        if url not in cache:
+            full_url = url if url.startswith('http') else f"{self.base_url}{url}"
+            try:
+                cache[url] = len(requests.get(full_url, timeout=60).content)
+            except Exception:
+                cache[url] = 0
+        return cache[url]
+
+    def srcset_url(self, srcset, index):
+        """URL de la variante en la posición index (0 = la más chica) de un srcset"""
+        entries = [entry.strip().split(' ')[0] for entry in (srcset or '').split(',') if entry.strip()]
+        if not entries:
+            return None
+        return entries[min(index, len(entries) - 1)]
+
+    def bench_page_bytes(self):
+        """Bytes por página de servicios y galería: imágenes originales vs variantes WebP"""
+        print("\n🖼️  Bytes por página (JSON + imágenes)")
+        cache = {}
+        pages = {
+            'services': [('imagen_url', 1)],
+            'gallery': [('imagen_antes', 1), ('imagen_despues', 1)]
+        }
+        for endpoint, fields in pages.items():
+            response = requests.get(f"{self.api_url}/{endpoint}", timeout=60)
+            items = response.json()
+            original = variants = len(response.content)
+            for item in items:
+                for field, index in fields:
+                    original += self.image_bytes(item.get(field), cache)
+                    variant_url = self.srcset_url((item.get(f"{field}_srcset") or {}).get('webp'), index)
+                    variants += self.image_bytes(variant_url or item.get(field), cache)
+            print(f"  /api/{endpoint}: originales={original / 1024:.1f}KB variantes={variants / 1024:.1f}KB")
+
+    def run_all(self):
+        print(f"🚀 Benchmarks contra: {self.base_url}")
+        self.setup()
+        # Primero, para medir la carga en frío antes de que otra petición la haga
+        self.bench_analytics_endpoints()
+        self.bench_login_burst()
+        self.bench_page_bytes()
+        self.bench_availability_range()
+        self.bench_export_stream()
+        self.bench_export_memory()
+        self.bench_scheduling_engine()
+        self.bench_analytics_engine()
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "https://beauty-touch-app.preview.emergentagent.com"
+    benchmark = BeautyTouchBenchmark(base_url)
+    benchmark.run_all()
+    return 1 if benchmark.failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
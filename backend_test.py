@@ -4,6 +4,8 @@ import json
 import base64
 from datetime import datetime, timedelta
 import uuid
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 class BeautyTouchAPITester:
     def __init__(self, base_url="https://beauty-touch-app.preview.emergentagent.com"):
@@ -226,6 +228,37 @@ class BeautyTouchAPITester:
             self.log_test("Double Booking Prevention", False, f"Expected 400, got {response.status_code if response else 'No response'}")
         return False
 
+    def test_concurrent_booking_race(self, attempts=200):
+        """Test that simultaneous bookings of one slot let exactly one through"""
+        print(f"\n🏁 Testing Concurrent Booking Race ({attempts} requests)...")
+        if not self.client_token or not self.test_service_id:
+            self.log_test("Concurrent Booking Race", False, "Missing client token or service ID")
+            return False
+        
+        # Un sábado lejano y aleatorio para no chocar con otras corridas
+        day = datetime.now() + timedelta(days=random.randint(200, 2000))
+        day += timedelta(days=(5 - day.weekday()) % 7)
+        booking = {
+            'service_id': self.test_service_id,
+            'fecha': day.strftime('%Y-%m-%d'),
+            'hora': '10:00'
+        }
+        
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            responses = list(pool.map(
+                lambda _: self.make_request('POST', 'appointments', booking, token=self.client_token),
+                range(attempts)
+            ))
+        
+        statuses = [r.status_code if r else None for r in responses]
+        succeeded = statuses.count(200)
+        rejected = statuses.count(400)
+        if succeeded == 1 and rejected == attempts - 1:
+            self.log_test("Concurrent Booking Race", True)
+            return True
+        self.log_test("Concurrent Booking Race", False, f"{succeeded} succeeded, {rejected} rejected, other: {attempts - succeeded - rejected}")
+        return False
+
     def test_get_client_appointments(self):
         """Test getting client appointments"""
         print("\n📋 Testing Client Appointments Retrieval...")
@@ -253,10 +286,10 @@ class BeautyTouchAPITester:
             self.log_test("Payment Proof Upload", False, "Missing client token or appointment ID")
             return False
         
-        # Create a dummy image file
-        dummy_image = base64.b64decode('/9j/4AAQSkZJRgABAQEAYABgAAD/2wBDAAEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/2wBDAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQEBAQH/wAARCAABAAEDASIAAhEBAxEB/8QAFQABAQAAAAAAAAAAAAAAAAAAAAv/xAAUEAEAAAAAAAAAAAAAAAAAAAAA/8QAFQEBAQAAAAAAAAAAAAAAAAAAAAX/xAAUEQEAAAAAAAAAAAAAAAAAAAAA/9oADAMBAAIRAxEAPwA/8A')
+        # 1x1 PNG: el tipo se comprueba contra el contenido del archivo
+        dummy_image = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
         
-        files = {'file': ('test_receipt.jpg', dummy_image, 'image/jpeg')}
+        files = {'file': ('test_receipt.png', dummy_image, 'image/png')}
         
         response = self.make_request('POST', f'appointments/{self.test_appointment_id}/upload-proof', 
                                    files=files, token=self.client_token)
@@ -265,12 +298,25 @@ class BeautyTouchAPITester:
             data = response.json()
             if 'message' in data:
                 self.log_test("Payment Proof Upload", True)
-                return True
             else:
                 self.log_test("Payment Proof Upload", False, "Invalid response structure")
+                return False
         else:
             self.log_test("Payment Proof Upload", False, f"Status: {response.status_code if response else 'No response'}")
-        return False
+            return False
+        
+        # El comprobante es privado: sin token ni firma no se sirve; la URL firmada sí
+        unsigned = requests.get(f"{self.api_url}/appointments/{self.test_appointment_id}/proof", timeout=30)
+        signed = requests.get(f"{self.base_url}{data['comprobante_url']}", timeout=30)
+        ok = (
+            unsigned.status_code == 401
+            and signed.status_code == 200
+            and signed.headers.get('Content-Type') == 'image/png'
+            and signed.headers.get('X-Content-Type-Options') == 'nosniff'
+            and signed.headers.get('Cache-Control', '').startswith('private')
+        )
+        self.log_test("Payment Proof Access", ok, f"Sin firma: {unsigned.status_code}, firmada: {signed.status_code}")
+        return ok
 
     def test_admin_stats(self):
         """Test admin statistics endpoint"""
@@ -293,6 +339,62 @@ class BeautyTouchAPITester:
             self.log_test("Admin Statistics", False, f"Status: {response.status_code if response else 'No response'}")
         return False
 
+    def test_admin_advanced_stats(self):
+        """Test advanced statistics with and without a date range"""
+        print("\n📈 Testing Admin Advanced Statistics...")
+        if not self.admin_token:
+            self.log_test("Admin Advanced Statistics", False, "Missing admin token")
+            return False
+        
+        response = self.make_request('GET', 'stats/advanced', token=self.admin_token)
+        if not response or response.status_code != 200:
+            self.log_test("Admin Advanced Statistics", False, f"Status: {response.status_code if response else 'No response'}")
+            return False
+        stats = response.json()
+        if len(stats.get('ocupacion_semanal', [])) != 7 or len(stats.get('servicios_populares', [])) > 5:
+            self.log_test("Admin Advanced Statistics", False, "Unexpected chart shapes")
+            return False
+        
+        # Un rango sin citas devuelve gráficos vacíos
+        response = self.make_request('GET', 'stats/advanced', {'desde': '2000-01-01', 'hasta': '2000-01-31'}, token=self.admin_token)
+        if response and response.status_code == 200:
+            empty = response.json()
+            if not empty['ingresos_mensuales'] and all(day['citas'] == 0 for day in empty['ocupacion_semanal']):
+                self.log_test("Admin Advanced Statistics", True)
+                return True
+            self.log_test("Admin Advanced Statistics", False, "Date range not applied")
+        else:
+            self.log_test("Admin Advanced Statistics", False, f"Status: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_admin_exports(self):
+        """Test streaming CSV/NDJSON exports"""
+        print("\n📤 Testing Admin Exports...")
+        if not self.admin_token:
+            self.log_test("Admin Exports", False, "Missing admin token")
+            return False
+        
+        headers = {'Authorization': f'Bearer {self.admin_token}'}
+        response = requests.get(f"{self.api_url}/export/appointments", params={'formato': 'csv'}, headers=headers, stream=True, timeout=60)
+        lines = [line for line in response.iter_lines(decode_unicode=True) if line]
+        if response.status_code != 200 or not lines or not lines[0].startswith('id,fecha,estado'):
+            self.log_test("Admin Exports", False, f"CSV status {response.status_code}, header {lines[:1]}")
+            return False
+        
+        response = requests.get(f"{self.api_url}/export/appointments", params={'formato': 'ndjson'}, headers=headers, stream=True, timeout=60)
+        try:
+            rows = [json.loads(line) for line in response.iter_lines(decode_unicode=True) if line]
+        except ValueError:
+            self.log_test("Admin Exports", False, "Invalid NDJSON line")
+            return False
+        
+        # Sin contar el encabezado, el CSV y el NDJSON traen las mismas citas
+        if response.status_code == 200 and len(rows) == len(lines) - 1:
+            self.log_test("Admin Exports", True, f"{len(rows)} appointments exported")
+            return True
+        self.log_test("Admin Exports", False, f"NDJSON status {response.status_code}, {len(rows)} rows vs {len(lines) - 1} CSV rows")
+        return False
+
     def test_admin_create_service(self):
         """Test admin service creation"""
         print("\n🛠️ Testing Admin Service Creation...")
@@ -340,6 +442,59 @@ class BeautyTouchAPITester:
             self.log_test("Admin All Appointments Retrieval", False, f"Status: {response.status_code if response else 'No response'}")
         return False
 
+    def test_admin_appointments_pagination(self):
+        """Test keyset pagination of admin appointments"""
+        print("\n📄 Testing Admin Appointments Pagination...")
+        if not self.admin_token:
+            self.log_test("Admin Appointments Pagination", False, "Missing admin token")
+            return False
+        
+        seen_ids = []
+        params = {'limit': 2}
+        for _ in range(3):
+            response = self.make_request('GET', 'appointments', params, token=self.admin_token)
+            if not response or response.status_code != 200:
+                self.log_test("Admin Appointments Pagination", False, f"Status: {response.status_code if response else 'No response'}")
+                return False
+            page = response.json()
+            if len(page) > 2:
+                self.log_test("Admin Appointments Pagination", False, f"Page has {len(page)} items, limit was 2")
+                return False
+            seen_ids.extend(apt['id'] for apt in page)
+            next_cursor = response.headers.get('X-Next-Cursor')
+            if not next_cursor:
+                break
+            params = {'limit': 2, 'cursor': next_cursor}
+        
+        if len(seen_ids) == len(set(seen_ids)):
+            self.log_test("Admin Appointments Pagination", True, f"{len(seen_ids)} appointments across pages")
+            return True
+        self.log_test("Admin Appointments Pagination", False, "Repeated appointments across pages")
+        return False
+
+    def test_query_counts(self):
+        """Test that list endpoints issue a constant number of Mongo queries (requires QUERY_COUNT_HEADER=true)"""
+        print("\n🔢 Testing Query Counts...")
+        limits = [
+            ('appointments', self.admin_token, 4),
+            ('stats/advanced', self.admin_token, 2),
+            ('gallery', None, 2),
+            ('packages', None, 2),
+            (f'reviews/{self.test_service_id}', None, 1)
+        ]
+        
+        for endpoint, token, max_queries in limits:
+            name = f"Query Count /api/{endpoint.split('/')[0]}"
+            response = self.make_request('GET', endpoint, token=token)
+            if not response or response.status_code != 200:
+                self.log_test(name, False, f"Status: {response.status_code if response else 'No response'}")
+                continue
+            if 'X-Query-Count' not in response.headers:
+                print(f"  ⏭️  {name} - SKIPPED (QUERY_COUNT_HEADER disabled)")
+                continue
+            count = int(response.headers['X-Query-Count'])
+            self.log_test(name, count <= max_queries, f"{count} queries (max {max_queries})")
+
     def test_admin_update_appointment_status(self):
         """Test admin updating appointment status"""
         print("\n✏️ Testing Admin Appointment Status Update...")
@@ -408,6 +563,100 @@ class BeautyTouchAPITester:
             self.log_test("Promotions Retrieval", False, f"Status: {response.status_code if response else 'No response'}")
         return False
 
+    def test_service_reviews(self):
+        """Test paginated reviews with the per-star histogram"""
+        print("\n⭐ Testing Service Reviews...")
+        if not self.test_service_id:
+            self.log_test("Service Reviews", False, "Missing service ID")
+            return False
+        
+        # Sin formato se conserva la respuesta original: una lista de reseñas
+        response = self.make_request('GET', f'reviews/{self.test_service_id}')
+        if not response or not isinstance(response.json(), list):
+            self.log_test("Service Reviews", False, "Default response is not a list")
+            return False
+        
+        seen_ids = []
+        params = {'limit': 2, 'orden': 'rating', 'formato': 'resumen'}
+        for _ in range(3):
+            response = self.make_request('GET', f'reviews/{self.test_service_id}', params)
+            if not response or response.status_code != 200:
+                self.log_test("Service Reviews", False, f"Status: {response.status_code if response else 'No response'}")
+                return False
+            data = response.json()
+            if sorted(data.get('histograma', {})) != ['1', '2', '3', '4', '5']:
+                self.log_test("Service Reviews", False, "Missing star histogram")
+                return False
+            ratings = [review['rating'] for review in data['reviews']]
+            if ratings != sorted(ratings, reverse=True) or not all('user_nombre' in review for review in data['reviews']):
+                self.log_test("Service Reviews", False, "Reviews not sorted by rating or missing user_nombre")
+                return False
+            seen_ids.extend(review['id'] for review in data['reviews'])
+            next_cursor = response.headers.get('X-Next-Cursor')
+            if not next_cursor:
+                break
+            params = {'limit': 2, 'orden': 'rating', 'formato': 'resumen', 'cursor': next_cursor}
+        
+        if len(seen_ids) == len(set(seen_ids)):
+            self.log_test("Service Reviews", True, f"{len(seen_ids)} reviews across pages")
+            return True
+        self.log_test("Service Reviews", False, "Repeated reviews across pages")
+        return False
+
+    def test_cancelled_appointment_stays_cancelled(self):
+        """A proof upload or a reactivation must not revive a cancelled appointment on a slot taken since"""
+        print("\n🚫 Testing Cancelled Appointment Slot...")
+        if not self.client_token or not self.admin_token or not self.test_service_id:
+            self.log_test("Cancelled Appointment Slot", False, "Missing tokens or service ID")
+            return False
+        
+        # Un martes lejano y al azar para no chocar con otras corridas
+        day = datetime.now() + timedelta(days=random.randint(200, 2000))
+        day += timedelta(days=(1 - day.weekday()) % 7)
+        slot = {'service_id': self.test_service_id, 'fecha': day.strftime('%Y-%m-%d'), 'hora': '12:00'}
+        admin = {'Authorization': f'Bearer {self.admin_token}'}
+        
+        first = self.make_request('POST', 'appointments', slot, token=self.client_token)
+        if first is None or first.status_code != 200:
+            self.log_test("Cancelled Appointment Slot", False, "Could not create appointment")
+            return False
+        cancelled_id = first.json()['id']
+        requests.put(f"{self.api_url}/appointments/{cancelled_id}/status", data={'estado': 'cancelada'}, headers=admin, timeout=30)
+        
+        # El horario liberado lo toma otra reserva
+        second = self.make_request('POST', 'appointments', slot, token=self.client_token)
+        proof = self.make_request('POST', f'appointments/{cancelled_id}/upload-proof', token=self.client_token,
+                                  files={'file': ('receipt.png', base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='), 'image/png')})
+        reactivate = requests.put(f"{self.api_url}/appointments/{cancelled_id}/status", data={'estado': 'confirmada'}, headers=admin, timeout=30)
+        appointments = self.make_request('GET', 'appointments', {'desde': slot['fecha'], 'hasta': slot['fecha'], 'service_id': self.test_service_id}, token=self.admin_token)
+        estados = {apt['id']: apt['estado'] for apt in appointments.json()} if appointments is not None and appointments.status_code == 200 else {}
+        
+        ok = (
+            second is not None and second.status_code == 200
+            and proof is not None and proof.status_code == 409
+            and reactivate.status_code == 400
+            and estados.get(cancelled_id) == 'cancelada'
+        )
+        self.log_test("Cancelled Appointment Slot", ok,
+                      f"Rebook: {second.status_code if second is not None else None}, proof: {proof.status_code if proof is not None else None}, "
+                      f"reactivate: {reactivate.status_code}, estado: {estados.get(cancelled_id)}")
+        return ok
+
+    def test_review_service_mismatch(self):
+        """A review must be for the appointment's own service"""
+        print("\n⭐ Testing Review Service Check...")
+        if not self.client_token or not self.test_appointment_id:
+            self.log_test("Review Service Check", False, "Missing client token or appointment ID")
+            return False
+        
+        review = {'appointment_id': self.test_appointment_id, 'service_id': 'otro-servicio', 'rating': 5, 'comentario': 'Excelente'}
+        response = self.make_request('POST', 'reviews', review, token=self.client_token)
+        if response is not None and response.status_code == 400:
+            self.log_test("Review Service Check", True)
+            return True
+        self.log_test("Review Service Check", False, f"Status: {response.status_code if response is not None else 'No response'}")
+        return False
+
     def test_availability_check(self):
         """Test availability checking"""
         print("\n🕐 Testing Availability Check...")
@@ -450,14 +699,22 @@ class BeautyTouchAPITester:
         # Client functionality
         self.test_create_appointment()
         self.test_double_booking_prevention()
+        self.test_concurrent_booking_race()
         self.test_get_client_appointments()
         self.test_upload_payment_proof()
+        self.test_review_service_mismatch()
+        self.test_cancelled_appointment_stays_cancelled()
         self.test_availability_check()
+        self.test_service_reviews()
         
         # Admin functionality
         self.test_admin_stats()
+        self.test_admin_advanced_stats()
+        self.test_admin_exports()
         self.test_admin_create_service()
         self.test_admin_get_all_appointments()
+        self.test_admin_appointments_pagination()
+        self.test_query_counts()
         self.test_admin_update_appointment_status()
         self.test_admin_create_promotion()
         
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Servidor falso de la API de mensajes de Twilio para probar el outbox sin red.
+
+Acepta POST /2010-04-01/Accounts/<sid>/Messages.json como Twilio y aplica
+un límite de mensajes por segundo por número remitente: al excederlo
+responde 429 con Retry-After. GET /messages lista lo recibido.
+
+Uso:
+    python fake_twilio_server.py --port 4010 --rate 1 --burst 1
+y en backend/.env:
+    TWILIO_API_URL=http://localhost:4010
+    TWILIO_ACCOUNT_SID=ACfake
+    TWILIO_AUTH_TOKEN=fake
+"""
+import argparse
+import math
+import time
+import uuid
+
+from aiohttp import web
+
+
+class FakeTwilio:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.messages = []
+        self.throttled = 0
+
+    def retry_after(self, sender):
+        """0 si el remitente tiene cupo (y lo consume); si no, segundos a esperar"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(sender, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self.buckets[sender] = (tokens - 1, now)
+            return 0
+        self.buckets[sender] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    async def create_message(self, request):
+        form = await request.post()
+        sender = form.get("From", "")
+        wait = self.retry_after(sender)
+        if wait > 0:
+            self.throttled += 1
+            return web.json_response(
+                {"code": 20429, "message": "Too Many Requests", "status": 429},
+                status=429,
+                headers={"Retry-After": str(max(1, math.ceil(wait)))}
+            )
+
+        message = {
+            "sid": f"SM{uuid.uuid4().hex}",
+            "account_sid": request.match_info["sid"],
+            "from": sender,
+            "to": form.get("To"),
+            "body": form.get("Body"),
+            "status": "queued",
+            "received_at": time.time()
+        }
+        self.messages.append(message)
+        return web.json_response(message, status=201)
+
+    async def list_messages(self, request):
+        return web.json_response({"messages": self.messages, "throttled": self.throttled})
+
+
+def create_app(rate=1.0, burst=1.0):
+    fake = FakeTwilio(rate, burst)
+    app = web.Application()
+    app["fake"] = fake
+    app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", fake.create_message)
+    app.router.add_get("/messages", fake.list_messages)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso de Twilio")
+    parser.add_argument("--port", type=int, default=4010)
+    parser.add_argument("--rate", type=float, default=1.0, help="Mensajes por segundo por remitente")
+    parser.add_argument("--burst", type=float, default=1.0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.rate, args.burst), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
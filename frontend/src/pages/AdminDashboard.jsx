@@ -456,7 +456,7 @@ export default function AdminDashboard({ user, onLogout }) {
                         type="file"
                         ref={fileInputRef}
                         onChange={(e) => handleImageUpload(service.id, e.target.files[0])}
-                        accept="image/*"
+                        accept="image/jpeg,image/png,image/webp"
                         className="hidden"
                         data-testid={`image-input-${service.id}`}
                       />
@@ -534,7 +534,13 @@ export default function AdminDashboard({ user, onLogout }) {
                         {apt.comprobante_pago && (
                           <div className="mb-3 p-3 bg-secondary rounded-lg">
                             <p className="text-sm font-medium mb-2">Comprobante de pago:</p>
-                            <img src={apt.comprobante_pago} alt="Comprobante" className="max-w-xs rounded border" data-testid={`proof-image-${apt.id}`} />
+                            {apt.comprobante_tipo === 'application/pdf' ? (
+                              <a href={apt.comprobante_pago} target="_blank" rel="noopener noreferrer" className="text-sm text-primary underline" data-testid={`proof-link-${apt.id}`}>
+                                Descargar comprobante (PDF)
+                              </a>
+                            ) : (
+                              <img src={apt.comprobante_pago} alt="Comprobante" className="max-w-xs rounded border" data-testid={`proof-image-${apt.id}`} />
+                            )}
                           </div>
                         )}
                         
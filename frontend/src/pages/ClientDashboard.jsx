@@ -212,7 +212,7 @@ export default function ClientDashboard({ user, onLogout }) {
                             type="file"
                             ref={(el) => (fileInputRefs.current[apt.id] = el)}
                             onChange={(e) => handleFileUpload(apt.id, e.target.files[0])}
-                            accept="image/*,.pdf"
+                            accept="image/jpeg,image/png,image/webp,application/pdf"
                             className="hidden"
                             data-testid={`file-input-${apt.id}`}
                           />
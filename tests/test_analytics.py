@@ -0,0 +1,109 @@
+import random
+import sys
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+np = pytest.importorskip("numpy")
+import analytics  # noqa: E402
+
+PRICES = {"srv-a": 50000, "srv-b": 80000, "srv-c": 35000}
+
+
+def random_docs(rng, n):
+    start = datetime(2024, 1, 1, 8)
+    docs = []
+    for _ in range(n):
+        fecha = start + timedelta(days=rng.randrange(0, 500), hours=rng.randrange(0, 12), minutes=rng.choice([0, 30]))
+        created = fecha - timedelta(hours=rng.randrange(1, 24 * 30))
+        doc = {
+            "fecha": fecha.isoformat(),
+            "created_at": created.isoformat() + "+00:00" if rng.random() > 0.05 else None,
+            "service_id": rng.choice(list(PRICES)),
+            "estado": rng.choice(analytics.STATES),
+        }
+        if rng.random() < 0.5:
+            doc["precio"] = rng.choice([40000, 60000])
+        docs.append(doc)
+    return docs
+
+
+def build(docs, batch=37):
+    builder = analytics.ColumnBuilder(PRICES)
+    for i in range(0, len(docs), batch):
+        builder.add_batch(docs[i:i + batch])
+    return builder.build()
+
+
+@pytest.fixture
+def docs():
+    return random_docs(random.Random(7), 2000)
+
+
+def test_heatmap_matches_bruteforce(docs):
+    cols = build(docs)
+    expected = np.zeros((7, 24), dtype=int)
+    for doc in docs:
+        if doc["estado"] != "cancelada":
+            fecha = datetime.fromisoformat(doc["fecha"])
+            expected[fecha.weekday(), fecha.hour] += 1
+    assert (analytics.occupancy_heatmap(cols, cols.window()) == expected).all()
+
+
+def test_revenue_by_service_month_matches_bruteforce(docs):
+    cols = build(docs)
+    desde, hasta = date(2024, 3, 1), date(2024, 8, 31)
+    expected = defaultdict(float)
+    for doc in docs:
+        day = datetime.fromisoformat(doc["fecha"]).date()
+        if doc["estado"] == "confirmada" and desde <= day <= hasta:
+            expected[(doc["fecha"][:7], doc["service_id"])] += doc.get("precio", PRICES[doc["service_id"]])
+    rows = analytics.revenue_by_service_month(cols, cols.window(desde, hasta))
+    assert {(row["mes"], row["service_id"]): row["ingresos"] for row in rows} == pytest.approx(dict(expected))
+
+
+def test_lead_time_and_cancellations_match_bruteforce(docs):
+    cols = build(docs)
+    hours = [
+        (datetime.fromisoformat(doc["fecha"]) - datetime.fromisoformat(doc["created_at"][:19])).total_seconds() / 3600
+        for doc in docs if doc["estado"] != "cancelada" and doc["created_at"]
+    ]
+    lead = analytics.lead_time(cols, cols.window())
+    assert lead["citas"] == len(hours)
+    assert lead["promedio_horas"] == pytest.approx(sum(hours) / len(hours), abs=0.05)
+
+    rates = analytics.cancellation_rates(cols, cols.window())
+    cancelled = Counter(doc["service_id"] for doc in docs if doc["estado"] == "cancelada")
+    assert rates["citas"] == len(docs)
+    assert {row["service_id"]: row["canceladas"] for row in rates["por_servicio"]} == dict(cancelled)
+
+
+def test_promotion_uplift_counts_bookings_in_windows(docs):
+    cols = build(docs)
+    start, end = datetime(2024, 6, 1), datetime(2024, 6, 15)
+    created = [datetime.fromisoformat(doc["created_at"][:19]) for doc in docs if doc["created_at"]]
+    during = sum(1 for c in created if start <= c < end)
+    before = sum(1 for c in created if start - (end - start) <= c < start)
+    starts = analytics.parse_local_epoch([start.isoformat()])
+    ends = analytics.parse_local_epoch([end.isoformat()])
+    [uplift] = analytics.promotion_uplift(cols, starts, ends)
+    assert (uplift["citas_durante"], uplift["citas_antes"]) == (during, before)
+
+
+def test_utc_offset_shifts_created_to_local_time():
+    doc = {"fecha": "2025-06-10T10:00:00", "created_at": "2025-06-09T15:00:00+00:00", "service_id": "srv-a", "estado": "pendiente"}
+    builder = analytics.ColumnBuilder(PRICES, utc_offset=-5 * 3600)
+    builder.add_batch([doc])
+    assert analytics.lead_time(builder.build(), np.ones(1, dtype=bool))["promedio_horas"] == 24.0
+
+
+def test_empty_columns():
+    cols = analytics.ColumnBuilder(PRICES).build()
+    mask = cols.window()
+    assert analytics.occupancy_heatmap(cols, mask).sum() == 0
+    assert analytics.revenue_by_service_month(cols, mask) == []
+    assert analytics.cancellation_rates(cols, mask)["citas"] == 0
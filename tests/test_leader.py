@@ -0,0 +1,121 @@
+"""Varios procesos del backend compiten por el lease del scheduler.
+
+Necesita una instancia de Mongo: MONGO_URL=mongodb://localhost:27017 pytest tests/test_leader.py
+Se usa una base de datos temporal que se borra al terminar.
+"""
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+pymongo = pytest.importorskip("pymongo")
+pytest.importorskip("motor")
+
+MONGO_URL = os.environ.get("MONGO_URL")
+WORKERS = 4
+APPOINTMENTS = 40
+
+
+def mongo_available():
+    if not MONGO_URL:
+        return False
+    try:
+        pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=1000).admin.command("ping")
+        return True
+    except Exception:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not mongo_available(), reason="MONGO_URL no apunta a un Mongo disponible")
+
+
+def run_backend_worker(db_name, seconds):
+    """Proceso hijo: importa el backend y compite por el lease durante unos segundos"""
+    import asyncio
+
+    os.environ.update({
+        "DB_NAME": db_name,
+        "TWILIO_ACCOUNT_SID": "ACtest",
+        "TWILIO_AUTH_TOKEN": "test",
+        "LEADER_LEASE_SECONDS": "1",
+        "REMINDER_REFILL_MINUTES": "1",
+    })
+    sys.path.insert(0, str(ROOT / "backend"))
+    import server
+
+    async def main():
+        # Sin workers del outbox: los mensajes quedan pendientes para contarlos
+        server.scheduler.add_job(server.reminder_timers.refill, "interval", minutes=server.REMINDER_REFILL_MINUTES)
+        server.scheduler.start(paused=True)
+        await server.scheduler_lease.start()
+        await asyncio.sleep(seconds)
+        await server.scheduler_lease.stop()
+        server.scheduler.shutdown()
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def test_db():
+    db_name = f"beautytouch_test_{uuid.uuid4().hex[:8]}"
+    client = pymongo.MongoClient(MONGO_URL)
+    db = client[db_name]
+    db.outbox.create_index("key", unique=True, partialFilterExpression={"key": {"$exists": True}})
+    yield db
+    client.drop_database(db_name)
+    client.close()
+
+
+def seed_appointments(db):
+    """Citas cuyo recordatorio vence escalonado en los próximos segundos"""
+    db.services.insert_one({"id": "srv-1", "nombre": "Manicure", "duracion": 60})
+    now = datetime.now()
+    for i in range(APPOINTMENTS):
+        db.users.insert_one({"id": f"user-{i}", "nombre": f"Cliente {i}", "telefono": f"+57300{i:07d}"})
+        db.appointments.insert_one({
+            "id": f"apt-{i}",
+            "user_id": f"user-{i}",
+            "service_id": "srv-1",
+            "fecha": (now + timedelta(hours=24, seconds=2 + i * 0.2)).isoformat(),
+            "estado": "confirmada",
+            "reminder_sent": False,
+        })
+
+
+def leader_pid(db):
+    lease = db.leases.find_one({"_id": "scheduler"})
+    return int(lease["owner"].split(":")[1]) if lease else None
+
+
+def test_each_reminder_is_sent_exactly_once_with_failover(test_db):
+    seed_appointments(test_db)
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=run_backend_worker, args=(test_db.name, 16)) for _ in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    # A mitad de los vencimientos se mata al líder sin que libere el lease
+    time.sleep(6)
+    pid = leader_pid(test_db)
+    assert pid in {worker.pid for worker in workers}
+    killed = next(worker for worker in workers if worker.pid == pid)
+    killed.kill()
+    tokens_before = test_db.leases.find_one({"_id": "scheduler"})["token"]
+
+    for worker in workers:
+        worker.join(30)
+
+    lease = test_db.leases.find_one({"_id": "scheduler"})
+    assert lease["token"] > tokens_before
+
+    assert test_db.appointments.count_documents({"reminder_sent": False}) == 0
+    per_phone = list(test_db.outbox.aggregate([{"$group": {"_id": "$to", "count": {"$sum": 1}}}]))
+    assert len(per_phone) == APPOINTMENTS
+    assert all(row["count"] == 1 for row in per_phone)
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+pytest.importorskip("motor")
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:1")
+os.environ.setdefault("DB_NAME", "beautytouch_test")
+import server  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    """Colección en memoria que registra cada find"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        [(key, condition)] = query.items()
+        return FakeCursor([doc for doc in self.docs if doc[key] in condition["$in"]])
+
+
+@pytest.fixture
+def users():
+    return FakeCollection([{"id": "u1", "nombre": "Ana"}, {"id": "u2", "nombre": "Luz"}])
+
+
+def test_loads_in_the_same_tick_share_one_query(users):
+    loader = server.BatchLoader(users)
+
+    async def scenario():
+        return await asyncio.gather(loader.load("u1"), loader.load("u2"), loader.load("u1"))
+
+    ana, luz, again = asyncio.run(scenario())
+    assert (ana["nombre"], luz["nombre"], again["nombre"]) == ("Ana", "Luz", "Ana")
+    assert users.queries == [{"id": {"$in": ["u1", "u2"]}}]
+
+
+def test_results_are_memoized_per_loader(users):
+    loader = server.BatchLoader(users)
+
+    async def scenario():
+        await loader.load_many(["u1"])
+        await loader.load_many(["u1", "u2"])
+
+    asyncio.run(scenario())
+    # La segunda tanda solo consulta la clave nueva
+    assert users.queries == [{"id": {"$in": ["u1"]}}, {"id": {"$in": ["u2"]}}]
+
+
+def test_missing_keys_resolve_to_none(users):
+    loader = server.BatchLoader(users)
+    assert asyncio.run(loader.load_many(["u2", "nadie"])) == [users.docs[1], None]
+
+
+def test_query_error_reaches_every_waiting_load():
+    class BrokenCollection(FakeCollection):
+        def find(self, query, projection=None):
+            raise RuntimeError("sin conexión")
+
+    loader = server.BatchLoader(BrokenCollection([]))
+
+    async def scenario():
+        return await asyncio.gather(loader.load("u1"), loader.load("u2"), return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(scenario())] == ["sin conexión", "sin conexión"]
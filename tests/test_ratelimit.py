@@ -0,0 +1,228 @@
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "backend"))
+sys.path.insert(0, str(ROOT))
+
+from ratelimit import TokenBucket  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_burst_then_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_rate_up_to_capacity():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    for _ in range(3):
+        bucket.try_acquire()
+    clock.now = 1.0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+    clock.now = 100.0
+    assert sum(1 for _ in range(5) if bucket.try_acquire() == 0) == 3
+
+
+def test_pause_blocks_until_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=10, clock=clock)
+    bucket.pause(5)
+    assert bucket.try_acquire() == pytest.approx(5)
+    clock.now = 5.0
+    assert bucket.try_acquire() == 0
+
+
+def test_rejects_non_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+async def send_burst(base_url, count, bucket=None):
+    import aiohttp
+
+    statuses = []
+    async with aiohttp.ClientSession() as session:
+        for i in range(count):
+            if bucket is not None:
+                await bucket.acquire()
+            async with session.post(
+                f"{base_url}/2010-04-01/Accounts/ACtest/Messages.json",
+                data={"From": "whatsapp:+14155238886", "To": f"whatsapp:+52{i}", "Body": "hola"}
+            ) as response:
+                statuses.append((response.status, response.headers.get("Retry-After")))
+    return statuses
+
+
+def run_against_fake_twilio(rate, burst, count, bucket=None):
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestServer
+    from fake_twilio_server import create_app
+
+    async def scenario():
+        server = TestServer(create_app(rate=rate, burst=burst))
+        await server.start_server()
+        try:
+            started = time.monotonic()
+            statuses = await send_burst(str(server.make_url("")).rstrip("/"), count, bucket)
+            return statuses, time.monotonic() - started
+        finally:
+            await server.close()
+
+    return asyncio.run(scenario())
+
+
+def test_fake_twilio_throttles_unlimited_burst():
+    statuses, _ = run_against_fake_twilio(rate=20, burst=5, count=15)
+    throttled = [retry_after for status, retry_after in statuses if status == 429]
+    assert sum(1 for status, _ in statuses if status == 201) >= 5
+    assert throttled and all(retry_after for retry_after in throttled)
+
+
+def test_bucket_keeps_under_fake_twilio_limit():
+    # El bucket local queda un poco por debajo del límite del proveedor
+    statuses, elapsed = run_against_fake_twilio(rate=20, burst=5, count=25, bucket=TokenBucket(rate=18, burst=4))
+    assert all(status == 201 for status, _ in statuses)
+    assert elapsed >= (25 - 4) / 18 * 0.9
+
+
+class FakeOutboxCollection:
+    """Colección outbox en memoria: aplica $set/$inc/$unset de update_one por id"""
+
+    def __init__(self, messages):
+        self.docs = {message["id"]: dict(message) for message in messages}
+
+    async def update_one(self, query, update):
+        doc = self.docs[query["id"]]
+        doc.update(update.get("$set", {}))
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+
+def outbox_message(i, attempts=1):
+    return {"id": f"msg-{i}", "channel": "whatsapp", "to": f"+52{i}", "body": "hola", "status": "sending", "attempts": attempts}
+
+
+@pytest.fixture
+def server_module(monkeypatch):
+    """El backend con el outbox sobre una colección en memoria (sin Mongo)"""
+    pytest.importorskip("motor")
+    pytest.importorskip("aiohttp")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:1")
+    os.environ.setdefault("DB_NAME", "beautytouch_test")
+    import server
+
+    def use_outbox(messages):
+        collection = FakeOutboxCollection(messages)
+        monkeypatch.setattr(server, "db", SimpleNamespace(outbox=collection))
+        return collection
+
+    server.use_outbox = use_outbox
+    return server
+
+
+def test_worker_survives_unexpected_delivery_error(server_module):
+    server = server_module
+    messages = [outbox_message(1), outbox_message(2)]
+    collection = server.use_outbox(messages)
+    outbox = server.NotificationOutbox(1)
+    pending = list(messages)
+    delivered = []
+
+    async def claim():
+        message = pending.pop(0)
+        # El worker termina después de procesar el último mensaje
+        outbox.stopping = not pending
+        return message
+
+    async def deliver(message):
+        if message["id"] == "msg-1":
+            raise RuntimeError("respuesta inesperada")
+        delivered.append(message["id"])
+
+    outbox.claim = claim
+    outbox.deliver = deliver
+    asyncio.run(asyncio.wait_for(outbox.run_worker(), timeout=5))
+
+    # El worker sigue con el siguiente mensaje y el que falló queda para reintento
+    assert delivered == ["msg-2"]
+    failed = collection.docs["msg-1"]
+    assert failed["status"] == "pending"
+    assert "respuesta inesperada" in failed["last_error"]
+    assert failed["next_attempt_at"] > server.utc_iso(server.datetime.now(server.timezone.utc))
+    assert outbox.metrics["failed"] == 1
+
+
+def test_outbox_pauses_and_requeues_on_twilio_429(server_module, monkeypatch):
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+    from fake_twilio_server import create_app
+
+    server = server_module
+    message = outbox_message(1)
+    collection = server.use_outbox([message])
+    monkeypatch.setattr(server, "twilio_account_sid", "ACtest")
+    monkeypatch.setattr(server, "twilio_auth_token", "test")
+
+    async def scenario():
+        twilio = TestServer(create_app(rate=1, burst=1))
+        await twilio.start_server()
+        base_url = str(twilio.make_url("")).rstrip("/")
+        monkeypatch.setattr(server, "TWILIO_API_URL", base_url)
+        outbox = server.NotificationOutbox(1)
+        outbox.session = aiohttp.ClientSession()
+        try:
+            # Otro envío del mismo remitente agota el cupo del proveedor
+            assert [status for status, _ in await send_burst(base_url, 1)] == [201]
+
+            await outbox.deliver(message)
+            requeued = dict(collection.docs[message["id"]])
+            retry_in = (
+                server.datetime.fromisoformat(requeued["next_attempt_at"]) - server.datetime.now(server.timezone.utc)
+            ).total_seconds()
+            paused_for = outbox.bucket_for("whatsapp").try_acquire()
+
+            # Siguiente toma del worker, cuando vence Retry-After
+            await asyncio.sleep(max(retry_in, 0))
+            retry = {**requeued, "status": "sending", "attempts": requeued["attempts"] + 1}
+            await outbox.deliver(retry)
+            return requeued, retry_in, paused_for, twilio.app["fake"]
+        finally:
+            await outbox.session.close()
+            await twilio.close()
+
+    requeued, retry_in, paused_for, fake = asyncio.run(scenario())
+
+    # 429 con Retry-After: 1 -> el bucket se pausa y el mensaje vuelve a la cola sin gastar el intento
+    assert requeued["status"] == "pending"
+    assert requeued["attempts"] == message["attempts"] - 1
+    assert requeued["last_error"].startswith("429")
+    assert 0.5 < retry_in <= 1.0
+    assert 0.5 < paused_for <= 1.0
+    assert fake.throttled == 1
+
+    # El reintento se envía una sola vez
+    sent = [m for m in fake.messages if m["to"] == f"whatsapp:{message['to']}"]
+    assert len(sent) == 1
+    assert collection.docs[message["id"]]["status"] == "sent"
+    assert "locked_until" not in collection.docs[message["id"]]
@@ -0,0 +1,79 @@
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+from scheduling import BusyIntervals, format_minute, minute_of_day  # noqa: E402
+
+
+def brute_overlaps(intervals, start, end):
+    return any(s < end and start < e for s, e in intervals)
+
+
+def random_intervals(rng, count):
+    intervals = []
+    for _ in range(count):
+        start = rng.randrange(0, 24 * 60 - 1)
+        intervals.append((start, start + rng.randint(1, 180)))
+    return intervals
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_overlaps_matches_brute_force(seed):
+    rng = random.Random(seed)
+    intervals = random_intervals(rng, rng.randint(0, 40))
+    busy = BusyIntervals()
+    for start, end in intervals:
+        busy.add(start, end)
+
+    for _ in range(200):
+        start = rng.randrange(0, 24 * 60)
+        end = start + rng.randint(1, 180)
+        assert busy.overlaps(start, end) == brute_overlaps(intervals, start, end)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_blocks_stay_sorted_and_disjoint(seed):
+    rng = random.Random(seed)
+    busy = BusyIntervals()
+    for start, end in random_intervals(rng, rng.randint(1, 60)):
+        busy.add(start, end)
+        assert all(s < e for s, e in zip(busy.starts, busy.ends))
+        assert all(e < s for e, s in zip(busy.ends, busy.starts[1:]))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_free_starts_matches_brute_force(seed):
+    rng = random.Random(seed)
+    intervals = random_intervals(rng, rng.randint(0, 15))
+    busy = BusyIntervals()
+    for start, end in intervals:
+        busy.add(start, end)
+
+    candidates = list(range(10 * 60, 19 * 60 + 1, 30))
+    duration = rng.choice([30, 60, 90])
+    expected = [c for c in candidates if not brute_overlaps(intervals, c, c + duration)]
+    assert busy.free_starts(candidates, duration) == expected
+    assert busy.free_starts(candidates, duration, limit=2) == expected[:2]
+
+
+def test_half_open_intervals_do_not_overlap_at_boundaries():
+    busy = BusyIntervals()
+    busy.add(minute_of_day("10:00"), minute_of_day("11:30"))
+    assert busy.overlaps(minute_of_day("10:30"), minute_of_day("11:30"))
+    assert not busy.overlaps(minute_of_day("11:30"), minute_of_day("12:30"))
+    assert not busy.overlaps(minute_of_day("09:00"), minute_of_day("10:00"))
+
+
+def test_rejects_empty_interval():
+    with pytest.raises(ValueError):
+        BusyIntervals().add(600, 600)
+
+
+def test_minute_conversions():
+    assert minute_of_day("19:00") == 1140
+    assert minute_of_day("10:30:00") == 630
+    assert format_minute(630) == "10:30"
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+pytest.importorskip("motor")
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:1")
+os.environ.setdefault("DB_NAME", "beautytouch_test")
+import server  # noqa: E402
+from fastapi.security import HTTPAuthorizationCredentials  # noqa: E402
+
+
+def payload(user_id, exp):
+    return {"user_id": user_id, "email": f"{user_id}@example.com", "role": "cliente", "exp": exp}
+
+
+def test_expired_token_misses(monkeypatch):
+    cache = server.VerifiedTokenCache(10)
+    now = time.time()
+    cache.put("tok", payload("u1", now + 60))
+    assert cache.get("tok")["user_id"] == "u1"
+
+    monkeypatch.setattr(server.time, "time", lambda: now + 61)
+    assert cache.get("tok") is None
+    assert cache.stats() == {"enabled": True, "size": 0, "hits": 1, "misses": 1}
+
+
+def test_size_never_exceeds_max_and_evicts_least_recent():
+    cache = server.VerifiedTokenCache(3)
+    exp = time.time() + 3600
+    for i in range(3):
+        cache.put(f"tok-{i}", payload(f"u{i}", exp))
+    # Usar tok-0 lo vuelve el más reciente: el siguiente desalojado es tok-1
+    assert cache.get("tok-0") is not None
+    for i in range(3, 50):
+        cache.put(f"tok-{i}", payload(f"u{i}", exp))
+        assert len(cache.entries) <= 3
+        assert len(cache.expirations) <= 2 * 3 + 1
+    assert cache.get("tok-1") is None
+    assert [cache.get(f"tok-{i}")["user_id"] for i in (47, 48, 49)] == ["u47", "u48", "u49"]
+
+
+def test_disabled_cache_stores_nothing():
+    cache = server.VerifiedTokenCache(10, enabled=False)
+    cache.put("tok", payload("u1", time.time() + 60))
+    assert cache.get("tok") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_invalidated_token_is_verified_again(monkeypatch):
+    monkeypatch.setattr(server, "token_cache", server.VerifiedTokenCache(10))
+    decode_calls = []
+    real_decode = server.jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        decode_calls.append(args[0])
+        return real_decode(*args, **kwargs)
+
+    monkeypatch.setattr(server.jwt, "decode", counting_decode)
+    token = server.create_token("u1", "u1@example.com", "cliente")
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    async def authenticate():
+        return (await server.get_current_user(credentials))["user_id"]
+
+    assert asyncio.run(authenticate()) == "u1"
+    assert asyncio.run(authenticate()) == "u1"
+    assert len(decode_calls) == 1
+
+    server.token_cache.invalidate(token=token)
+    assert asyncio.run(authenticate()) == "u1"
+    assert len(decode_calls) == 2
+
+    server.token_cache.invalidate(user_id="u1")
+    assert asyncio.run(authenticate()) == "u1"
+    assert len(decode_calls) == 3